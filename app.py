@@ -1,14 +1,21 @@
 import streamlit as st
+import ast
+import io
 import json
 import os
+import threading
 import time
+from collections import deque
 from PIL import Image
-import numpy as np
+import atexit
 import logging
+import logging.handlers
+import queue
 
-# Import the handlers
-from llm_singleton import get_llm_handler
-from rag_handler import RAGHandler
+# The handlers (and their heavy dependency chains: ollama, llama_index,
+# pyautogui) are imported lazily inside the functions that use them, so
+# Streamlit's frequent full-script reruns and the Settings page don't pay
+# for them.
 # from ocr_helper import get_all_ocr_results, draw_ocr_results # Moved to run_automation_flow
 
 import subprocess
@@ -21,70 +28,288 @@ def get_desktop_controller():
     return DesktopController()
 
 
+@st.cache_resource
+def get_rag_handler():
+    """Initializes and returns a cached RAGHandler instance."""
+    from rag_handler import RAGHandler
+    return RAGHandler()
+
+
+def _prewarm_handlers():
+    """
+    Warms the heavy singletons (LLM handler, RAG index, OCR models) in the
+    background while the user is still typing their first command, so the
+    first run doesn't pay all the initialization cost at once.
+    """
+    try:
+        from llm_singleton import get_llm_handler
+        llm_handler = get_llm_handler()
+        # Prefill the Ollama KV cache for the generation system prompt so the
+        # first real generation skips most of its prefill cost.
+        screen_size = get_desktop_controller().get_screen_size()
+        llm_handler.warm_generation_cache(screen_size, load_config().get('cdp_url', '').strip())
+    except Exception as e:
+        logging.warning(f"Pre-warm of LLM handler failed: {e}")
+    try:
+        get_rag_handler()
+    except Exception as e:
+        logging.warning(f"Pre-warm of RAG handler failed: {e}")
+    try:
+        import ocr_helper
+        ocr_helper._get_reader()  # The reader is lazy; force the model load here.
+    except Exception as e:
+        logging.warning(f"Pre-warm of OCR reader failed: {e}")
+
+
+@st.cache_resource
+def get_thread_pool():
+    """Returns a shared thread pool for overlapping OCR, RAG and LLM work."""
+    from concurrent.futures import ThreadPoolExecutor
+    return ThreadPoolExecutor(max_workers=4)
+
+
 # --- Playwright Setup ---
+PLAYWRIGHT_MARKER_FILE = ".deskagent_pw_installed"
+
+def _playwright_already_installed() -> bool:
+    """
+    Cheaply checks whether Playwright browsers are already installed by
+    probing the browsers cache directory and a local marker file recording
+    the Playwright version we installed for. Avoids shelling out to
+    `playwright install` (which performs real install work) on every start.
+    """
+    # Check the marker first: when it is absent we can answer without even
+    # importing playwright, keeping the common cold-start path to one stat.
+    if not os.path.exists(PLAYWRIGHT_MARKER_FILE):
+        return False
+
+    try:
+        from playwright import __version__ as pw_version
+    except ImportError:
+        return False
+
+    browsers_dir = os.environ.get(
+        "PLAYWRIGHT_BROWSERS_PATH",
+        os.path.expanduser(os.path.join("~", ".cache", "ms-playwright"))
+    )
+    if not os.path.isdir(browsers_dir):
+        return False
+
+    with open(PLAYWRIGHT_MARKER_FILE, 'r', encoding='utf-8') as f:
+        return f.read().strip() == pw_version
+
+
 @st.cache_resource
 def setup_playwright():
     """
-    Ensures Playwright browsers are installed. This is cached so it only runs once.
+    Ensures Playwright browsers are installed. This is cached so it only runs once,
+    and a marker file makes subsequent server starts skip the subprocess entirely.
     """
     append_log("[SETUP] Checking Playwright installation...")
-    try:
-        # Check if browsers are installed by trying to access the command
-        subprocess.check_output(['playwright', 'install', '--with-deps'], stderr=subprocess.STDOUT, text=True)
+    if _playwright_already_installed():
         append_log("[SUCCESS] Playwright browsers are installed.")
-    except (subprocess.CalledProcessError, FileNotFoundError) as e:
-        append_log("[INFO] Playwright browsers not found or error during check. Attempting installation...")
+        return
+
+    append_log("[INFO] Playwright browsers not found. Attempting installation...")
+    try:
+        install_process = subprocess.run(
+            ['playwright', 'install'],
+            capture_output=True, text=True, check=True
+        )
+        append_log("[SUCCESS] Playwright browsers installed successfully.")
+        append_log(install_process.stdout)
         try:
-            install_process = subprocess.run(
-                ['playwright', 'install', '--with-deps'],
-                capture_output=True, text=True, check=True
-            )
-            append_log("[SUCCESS] Playwright browsers installed successfully.")
-            append_log(install_process.stdout)
-        except Exception as install_error:
-            append_log(f"[ERROR] Failed to install Playwright browsers: {install_error}")
-            st.error("Failed to install Playwright components. Please run 'playwright install --with-deps' manually in your terminal.")
-            st.stop()
+            from playwright import __version__ as pw_version
+            with open(PLAYWRIGHT_MARKER_FILE, 'w', encoding='utf-8') as f:
+                f.write(pw_version)
+        except Exception:
+            pass  # The marker is only an optimization; skipping it is harmless.
+    except Exception as install_error:
+        append_log(f"[ERROR] Failed to install Playwright browsers: {install_error}")
+        st.error("Failed to install Playwright components. Please run 'playwright install --with-deps' manually in your terminal.")
+        st.stop()
 
 
 # --- Configuration and Logging ---
 CONFIG_FILE = "config.json"
 LOG_FILE = "app.log"
 
-logging.basicConfig(level=logging.INFO,
-                    format='%(asctime)s - %(levelname)s - %(message)s',
-                    handlers=[logging.FileHandler(LOG_FILE, mode='w'),
-                              logging.StreamHandler()])
+def _setup_logging():
+    """
+    Configures queue-based logging: append_log enqueues records in O(1) and a
+    background listener thread does the actual disk/console writes, keeping
+    synchronous I/O out of the automation hot path. Guarded so Streamlit's
+    script reruns don't stack up extra listeners.
+    """
+    root = logging.getLogger()
+    if any(isinstance(h, logging.handlers.QueueHandler) for h in root.handlers):
+        return
+
+    formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+    # Append and rotate instead of truncating on every process start;
+    # delay=True defers opening the file until the first record is written.
+    file_handler = logging.handlers.RotatingFileHandler(
+        LOG_FILE, maxBytes=2_000_000, backupCount=3, encoding='utf-8', delay=True)
+    file_handler.setFormatter(formatter)
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(formatter)
+
+    log_queue = queue.Queue(-1)
+    listener = logging.handlers.QueueListener(log_queue, file_handler, stream_handler)
+    listener.start()
+    atexit.register(listener.stop)
+
+    root.setLevel(logging.INFO)
+    root.addHandler(logging.handlers.QueueHandler(log_queue))
+
+_setup_logging()
+
+# In-memory cache for the parsed config, keyed on the file's mtime so
+# external edits are still picked up without re-parsing on every rerun.
+_config_cache = {"mtime": None, "config": None}
 
 def load_config():
-    """Loads configuration from JSON file."""
+    """Loads configuration from JSON file, reusing the parsed copy when unchanged."""
     if not os.path.exists(CONFIG_FILE):
         st.error(f"Configuration file '{CONFIG_FILE}' not found. Please create it.")
         st.stop()
+    mtime = os.path.getmtime(CONFIG_FILE)
+    if _config_cache["mtime"] == mtime:
+        return _config_cache["config"]
     with open(CONFIG_FILE, 'r', encoding='utf-8') as f:
-        return json.load(f)
+        config = json.load(f)
+    _config_cache["mtime"] = mtime
+    _config_cache["config"] = config
+    return config
 
 def save_config(config):
-    """Saves configuration to JSON file."""
-    with open(CONFIG_FILE, 'w', encoding='utf-8') as f:
+    """Saves configuration to JSON file atomically (write temp file, then replace)."""
+    tmp_path = CONFIG_FILE + ".tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
         json.dump(config, f, indent=4, ensure_ascii=False)
+    os.replace(tmp_path, CONFIG_FILE)
+    _config_cache["mtime"] = None  # Invalidate so the next load re-reads
 
 def append_log(message):
     """Appends a message to the log display in the Streamlit UI."""
     logging.info(message)
-    st.session_state.logs += f"[{time.strftime('%H:%M:%S')}] {message}\n"
+    # The log buffer is a bounded deque: O(1) appends instead of copying the
+    # whole string on every message, and memory stays capped in long sessions.
+    st.session_state.logs.append(f"[{time.strftime('%H:%M:%S')}] {message}")
 
 
-def cleanup_temp_files(files: list):
-    """Deletes temporary files like screenshots."""
-    append_log(f"Cleaning up {len(files)} temporary file(s)...")
+def encode_jpeg_bytes(img: Image.Image, quality: int = 85, max_edge: int = 1280) -> bytes:
+    """
+    Encodes a PIL image to JPEG bytes in memory for the LLM payload.
+    The image is downscaled to at most `max_edge` on its longest side first;
+    vision models resize internally anyway, so full-resolution uploads only
+    waste bandwidth. JPEG is 5-10x smaller than PNG for screenshots and
+    skips the disk round-trip entirely.
+    """
+    rgb = img.convert('RGB')
+    rgb.thumbnail((max_edge, max_edge), Image.LANCZOS)
+    buf = io.BytesIO()
+    # optimize=False skips a second encoder pass; the vision model doesn't
+    # benefit from the marginally smaller file.
+    rgb.save(buf, format='JPEG', quality=quality, optimize=False, subsampling=1)
+    return buf.getvalue()
+
+
+def wait_for_script_completion(timeout: float = 3.0, poll_interval: float = 0.05):
+    """
+    Waits until the executed script signals completion via its sentinel file,
+    up to `timeout` seconds. Long-running scripts (e.g. ones that keep a
+    browser open) never touch the flag, so the timeout bounds the wait.
+    """
+    from desktop_controller import SCRIPT_DONE_FLAG
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if os.path.exists(SCRIPT_DONE_FLAG):
+            return
+        time.sleep(poll_interval)
+
+
+def retry_backoff(attempt: int, base: float = 0.25, max_wait: float = 2.0):
+    """Sleeps with exponential backoff before the next retry attempt."""
+    time.sleep(min(max_wait, base * (2 ** attempt)))
+
+
+def rate_limit_backoff(attempt: int, base: float = 0.5, max_wait: float = 8.0):
+    """
+    Longer, jittered backoff for rate-limited/overloaded LLM responses.
+    The jitter avoids retries from concurrent sessions landing in lockstep.
+    """
+    import random
+    time.sleep(min(max_wait, base * (2 ** attempt)) + random.uniform(0, 0.5))
+
+
+def _do_cleanup(files: set):
+    """Unlinks the given files; runs on a background thread."""
     for file_path in files:
         try:
-            if os.path.exists(file_path):
-                os.remove(file_path)
-                append_log(f"Deleted {file_path}")
-        except Exception as e:
-            append_log(f"Error deleting {file_path}: {e}")
+            os.unlink(file_path)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logging.warning(f"Error deleting {file_path}: {e}")
+
+
+def cleanup_temp_files(files: list):
+    """Deletes temporary files like screenshots, without blocking the UI."""
+    # Deduplicate: the retry loop appends the same log/script filenames once
+    # per attempt. The unlinks happen on a daemon thread with one summary log
+    # line, so the end of a run isn't stalled by N syscalls + N log rerenders.
+    unique_files = set(files)
+    if not unique_files:
+        return
+    append_log(f"Cleaning up {len(unique_files)} temporary file(s) in the background...")
+    threading.Thread(target=_do_cleanup, args=(unique_files,), daemon=True).start()
+
+class _TypedTextFound(Exception):
+    """Raised by _TypedTextVisitor to short-circuit the AST walk on the first match."""
+    def __init__(self, text: str):
+        self.text = text
+
+
+class _TypedTextVisitor(ast.NodeVisitor):
+    """Finds the first string literal passed to pyperclip.copy or pyautogui.typewrite."""
+    _TARGETS = {('pyperclip', 'copy'), ('pyautogui', 'typewrite')}
+
+    def visit_Call(self, node):
+        func = node.func
+        if isinstance(func, ast.Attribute) and \
+           isinstance(func.value, ast.Name) and \
+           (func.value.id, func.attr) in self._TARGETS and \
+           node.args and isinstance(node.args[0], ast.Constant) and \
+           isinstance(node.args[0].value, str):
+            raise _TypedTextFound(node.args[0].value)
+        self.generic_visit(node)
+
+
+def is_valid_generated_code(code: str) -> bool:
+    """
+    Cheap static validation of a generated script: it must parse and use at
+    least one of the automation libraries the system prompt mandates.
+    """
+    try:
+        ast.parse(code)
+    except SyntaxError:
+        return False
+    return any(lib in code for lib in ("pyautogui", "pyperclip", "playwright"))
+
+
+def extract_typed_text(code: str):
+    """
+    Safely parses generated code and returns the first text literal it types
+    (via pyperclip.copy or pyautogui.typewrite), or None if there is none.
+    """
+    tree = ast.parse(code)
+    try:
+        _TypedTextVisitor().visit(tree)
+    except _TypedTextFound as found:
+        return found.text
+    return None
+
 
 # --- Main Application Logic ---
 def run_automation_flow(command: str, cdp_url: str = ""):
@@ -94,66 +319,161 @@ def run_automation_flow(command: str, cdp_url: str = ""):
         append_log(f"Using browser CDP endpoint: {cdp_url}")
     st.session_state.screenshots_to_cleanup = []
 
+    from llm_singleton import get_llm_handler
+    from llm_handler import LLMRateLimitError
+
     try:
         # 1. Initialization
         append_log("Initializing handlers...")
         config = load_config()
         controller = get_desktop_controller()
-        llm_handler = get_llm_handler()
-        rag_handler = RAGHandler()
+        llm_handler = get_llm_handler(config)
+        rag_handler = get_rag_handler()
         max_retries = config.get('max_retries', 3)
         operation_successful = False
         final_code = ""
 
-        # 2. Get Abstract Prompt for RAG
+        pool = get_thread_pool()
+
+        # 2. Get Abstract Prompt for RAG. It only gates the RAG search, so it
+        # runs in the background, overlapped with the first screen capture.
         append_log("Generalizing user command for RAG search...")
-        abstract_prompt = llm_handler.abstract_user_prompt(command)
-        st.session_state.abstract_prompt_for_saving = abstract_prompt
-        append_log(f"Generalized command: '{abstract_prompt}'")
+        abstract_future = pool.submit(llm_handler.abstract_user_prompt, command)
+        abstract_prompt = None
+
+        # Screen size is constant within a session; query it once per run
+        # instead of once per retry attempt.
+        screen_size = controller.get_screen_size()
+
+        # The "after" frame of a failed attempt doubles as the "before" frame
+        # of the next one — both the PIL image and its encoded JPEG bytes are
+        # carried, saving a capture and an encode per retry. Reset to None
+        # whenever the screen state is unknown (e.g. a script crashed mid-run).
+        carried_before_img = None
+        carried_before_bytes = None
 
         for attempt in range(max_retries):
             append_log(f"--- Attempt {attempt + 1} of {max_retries} ---")
 
-            # 3. Capture "Before" State
+            # 3 & 4. Capture "Before" State and RAG Search (concurrently)
             from ocr_helper import get_all_ocr_results, draw_ocr_results # Import here
             append_log("Capturing 'before' screen and performing OCR...")
-            before_screenshot_img, ocr_results = get_all_ocr_results()
-            before_screenshot_path = controller.save_screenshot(before_screenshot_img, "before")
-            st.session_state.screenshots_to_cleanup.append(before_screenshot_path)
+            if carried_before_img is not None:
+                ocr_future = pool.submit(get_all_ocr_results, image=carried_before_img)
+            else:
+                ocr_future = pool.submit(get_all_ocr_results)
+
+            if abstract_prompt is None:
+                abstract_prompt = abstract_future.result()
+                st.session_state.abstract_prompt_for_saving = abstract_prompt
+                append_log(f"Generalized command: '{abstract_prompt}'")
 
-            # Visualize OCR results
-            visualized_img = draw_ocr_results(before_screenshot_img.copy(), ocr_results)
-            st.image(visualized_img, caption=f"OCR Visualization (Attempt {attempt+1})")
+            append_log("Searching for similar successful examples (RAG)...")
+            rag_future = pool.submit(rag_handler.retrieve_similar_examples, abstract_prompt)
+
+            before_screenshot_img, ocr_results = ocr_future.result()
+            # Keep the "before" frame in memory as JPEG bytes; the LLM accepts
+            # raw bytes, so no PNG encode + disk write is needed per attempt.
+            # A carried frame already has its bytes; otherwise the encode runs
+            # on the pool so it overlaps the RAG retrieval.
+            encode_future = None
+            if carried_before_bytes is None:
+                encode_future = pool.submit(encode_jpeg_bytes, before_screenshot_img)
 
             # For RAG, we only need the text content
             ocr_texts_for_rag = [{'text': text} for _, text, _ in ocr_results]
 
-            # 4. RAG Search
-            append_log("Searching for similar successful examples (RAG)...")
-            rag_examples = rag_handler.retrieve_similar_examples(abstract_prompt)
+            rag_examples = rag_future.result()
+            before_screenshot_bytes = carried_before_bytes if encode_future is None else encode_future.result()
             if rag_examples:
                 append_log(f"[INFO] Found {len(rag_examples)} relevant example(s).")
             else:
                 append_log("[INFO] No similar examples found. Proceeding with base model.")
 
-            # 5. Generate Code
-            screen_size = controller.get_screen_size()
-            append_log(f"Generating automation code (Screen: {screen_size[0]}x{screen_size[1]})...")
-            generated_code = llm_handler.generate_automation_code(
-                command,
-                screen_size,
-                before_screenshot_path,
-                rag_examples,
-                cdp_url=cdp_url
-            )
+            # 5. Generate Code. A structural RAG hit (same prompt shape as a
+            # stored automation, different literal arguments) synthesizes the
+            # code directly and skips the LLM entirely. Otherwise a
+            # speculative second sample runs on the pool at a higher
+            # temperature while the primary one streams on this thread; the
+            # first candidate that passes static validation wins.
+            generated_code = ""
+            # The structural lookup is deterministic, so only the first
+            # attempt may use it: if the synthesized script crashed or failed
+            # evaluation, later attempts would replay the identical code and
+            # never consult the LLM (same replay hazard as the response
+            # cache, which is likewise gated to attempt 0).
+            structural_code = rag_handler.try_generative_hit(command) if attempt == 0 else None
+            if structural_code and is_valid_generated_code(structural_code):
+                append_log("[SUCCESS] Structural RAG hit: reused stored code with new arguments (no LLM call).")
+                generated_code = structural_code
+                code_placeholder = st.empty()
+            else:
+                append_log(f"Generating automation code (Screen: {screen_size[0]}x{screen_size[1]})...")
+                # Only the first attempt may read the response cache: after a
+                # failed attempt with an unchanged screen the key is identical,
+                # and a cached read would replay the same failing code for the
+                # rest of the retry budget instead of re-sampling the model.
+                read_cache = attempt == 0
+                spec_future = pool.submit(
+                    llm_handler.generate_automation_code,
+                    command,
+                    screen_size,
+                    before_screenshot_bytes,
+                    rag_examples,
+                    cdp_url=cdp_url,
+                    temperature=0.8,
+                    read_cache=read_cache
+                )
+
+                # Visualize OCR results before streaming occupies this thread
+                # (debug only: the draw pass ships a frame over the WebSocket)
+                if st.session_state.get('show_ocr_viz'):
+                    visualized_img = draw_ocr_results(before_screenshot_img.copy(), ocr_results)
+                    st.image(visualized_img, caption=f"OCR Visualization (Attempt {attempt+1})", output_format='JPEG')
+
+                # Stream the primary generation into a live placeholder so the
+                # user reads code as it is produced instead of watching a
+                # spinner; perceived latency drops to time-to-first-token.
+                code_placeholder = st.empty()
+                chunks = []
+                try:
+                    for token in llm_handler.generate_automation_code_stream(
+                            command, screen_size, before_screenshot_bytes, rag_examples,
+                            cdp_url=cdp_url, temperature=0.2, read_cache=read_cache):
+                        chunks.append(token)
+                        code_placeholder.code("".join(chunks), language='python')
+                    primary_code = llm_handler._clean_generated_code("".join(chunks))
+
+                    fallback_code = ""
+                    if primary_code and is_valid_generated_code(primary_code):
+                        generated_code = primary_code
+                        spec_future.cancel()
+                    else:
+                        fallback_code = primary_code
+                        candidate = spec_future.result()
+                        if candidate and is_valid_generated_code(candidate):
+                            generated_code = candidate
+                        elif candidate and not fallback_code:
+                            fallback_code = candidate
+                except LLMRateLimitError as e:
+                    append_log(f"[WARNING] LLM server is overloaded ({e}). Backing off before retry...")
+                    spec_future.cancel()
+                    carried_before_img = before_screenshot_img  # Nothing executed; screen unchanged
+                    carried_before_bytes = before_screenshot_bytes
+                    rate_limit_backoff(attempt)
+                    continue
+                if not generated_code:
+                    generated_code = fallback_code
 
             if not generated_code:
+                # A parse-level miss needs no cool-down; retry immediately.
                 append_log("[ERROR] LLM failed to generate code. Retrying...")
-                time.sleep(2)
+                carried_before_img = before_screenshot_img  # Nothing executed; screen unchanged
+                carried_before_bytes = before_screenshot_bytes
                 continue
 
             append_log("[SUCCESS] Code Generated:")
-            st.code(generated_code, language='python')
+            code_placeholder.code(generated_code, language='python')
             final_code = generated_code
 
             # 6. Execute Code
@@ -162,30 +482,52 @@ def run_automation_flow(command: str, cdp_url: str = ""):
                 controller.execute_code(generated_code)
                 st.session_state.screenshots_to_cleanup.extend(["temp_automation_script.py", "script_error.log", "script_output.log"])
                 append_log("[SUCCESS] Code execution command sent. Waiting for results...")
-                time.sleep(3)  # Wait for the script to execute and write logs
+                wait_for_script_completion()  # Returns as soon as the script exits, bounded by a timeout
 
                 # Crash Detection
-                if os.path.exists("script_error.log"):
-                    with open("script_error.log", "r", encoding='utf-8') as f:
+                # execute_code truncates the log files at launch, so any bytes
+                # present belong to this attempt. Gate on the size first: in the
+                # common success case the error log is empty and we skip the
+                # open+read entirely.
+                try:
+                    err_size = os.path.getsize("script_error.log")
+                except OSError:
+                    err_size = 0
+                if err_size:
+                    with open("script_error.log", "r", encoding='utf-8', buffering=65536) as f:
                         error_output = f.read().strip()
                     if error_output:
                         append_log(f"[ERROR] Script crashed. Error:\n{error_output}")
                         st.code(error_output, language='log')
                         append_log("Retrying...")
-                        time.sleep(2)
+                        carried_before_img = None  # Crash may have left the screen in an unknown state
+                        carried_before_bytes = None
+                        retry_backoff(attempt)
                         continue # Move to the next attempt
 
             except Exception as e:
                 append_log(f"[ERROR] Code execution failed to launch: {e}. Retrying...")
-                time.sleep(2)
+                carried_before_img = None
+                carried_before_bytes = None
+                retry_backoff(attempt)
                 continue
 
             # 7. Evaluate Result
             append_log("Capturing 'after' screen for evaluation...")
             after_screenshot_img = controller.capture_screenshot()
-            after_screenshot_path = controller.save_screenshot(after_screenshot_img, "after")
-            st.session_state.screenshots_to_cleanup.append(after_screenshot_path)
-            st.image(after_screenshot_img, caption=f"Screen After Attempt {attempt+1}")
+            carried_before_img = after_screenshot_img
+            after_screenshot_bytes = encode_jpeg_bytes(after_screenshot_img)
+            carried_before_bytes = after_screenshot_bytes
+            if st.session_state.get('show_ocr_viz'):
+                # On-disk artifacts are only useful for debugging; the LLM
+                # consumes the in-memory bytes directly.
+                after_screenshot_path = controller.save_screenshot(after_screenshot_img, "after")
+                st.session_state.screenshots_to_cleanup.append(after_screenshot_path)
+            st.image(after_screenshot_img, caption=f"Screen After Attempt {attempt+1}", output_format='JPEG')
+
+            def fallback_llm_evaluate() -> bool:
+                """Shared LLM evaluation used by both the OCR and non-OCR paths."""
+                return llm_handler.evaluate_operation(command, final_code, before_screenshot_bytes, after_screenshot_bytes)
 
             # --- OCR-based evaluation for typing tasks ---
             if any(keyword in command.lower() for keyword in ["type", "enter", "入力"]):
@@ -193,44 +535,21 @@ def run_automation_flow(command: str, cdp_url: str = ""):
                 # Extract the text to be typed from the generated code
                 # This is a bit brittle, assumes pyperclip.copy("text")
                 try:
-                    import ast
-
                     # Safely parse the code to find the text to be typed
-                    text_to_find = None
-                    tree = ast.parse(final_code)
-                    for node in ast.walk(tree):
-                        # Check for pyperclip.copy('...')
-                        if isinstance(node, ast.Call) and \
-                           isinstance(node.func, ast.Attribute) and \
-                           node.func.attr == 'copy' and \
-                           isinstance(node.func.value, ast.Name) and \
-                           node.func.value.id == 'pyperclip' and \
-                           node.args and isinstance(node.args[0], ast.Str):
-                            text_to_find = node.args[0].s
-                            break
-                        # Check for pyautogui.typewrite('...')
-                        if isinstance(node, ast.Call) and \
-                           isinstance(node.func, ast.Attribute) and \
-                           node.func.attr == 'typewrite' and \
-                           isinstance(node.func.value, ast.Name) and \
-                           node.func.value.id == 'pyautogui' and \
-                           node.args and isinstance(node.args[0], ast.Str):
-                            text_to_find = node.args[0].s
-                            break
+                    text_to_find = extract_typed_text(final_code)
 
                     if not text_to_find:
                         raise ValueError("Could not find text being typed in the generated code.")
 
                     append_log(f"Searching for text '{text_to_find}' in the 'after' screenshot...")
 
-                    # Get OCR results from the 'after' screenshot
-                    _, after_ocr_results = get_all_ocr_results(after_screenshot_path)
+                    # Get OCR results from the 'after' screenshot (reuse the in-memory image)
+                    _, after_ocr_results = get_all_ocr_results(image=after_screenshot_img)
 
-                    found_text = False
-                    for _, text, _ in after_ocr_results:
-                        if text_to_find in text:
-                            found_text = True
-                            break
+                    # Join once and search once: a single C-level substring scan,
+                    # and text split across adjacent OCR boxes can still match.
+                    haystack = "\n".join(text for _, text, _ in after_ocr_results)
+                    found_text = text_to_find in haystack
 
                     if found_text:
                         append_log(f"[SUCCESS] OCR validation: Found '{text_to_find}'.")
@@ -239,10 +558,13 @@ def run_automation_flow(command: str, cdp_url: str = ""):
                     else:
                         append_log(f"[ERROR] OCR validation: Did not find '{text_to_find}'. Retrying...")
 
-                except IndexError:
+                except (IndexError, ValueError, SyntaxError):
+                    # ValueError covers "no typed text found"; SyntaxError covers
+                    # unparsable generated code. Both previously fell through to
+                    # the outer handler and aborted the run instead of falling
+                    # back to LLM evaluation.
                     append_log("[WARNING] Could not parse text from code for OCR validation. Falling back to LLM.")
-                    # Fallback to LLM evaluation if parsing fails
-                    is_success = llm_handler.evaluate_operation(command, final_code, before_screenshot_path, after_screenshot_path)
+                    is_success = fallback_llm_evaluate()
                     if is_success:
                         operation_successful = True
                         break
@@ -250,7 +572,7 @@ def run_automation_flow(command: str, cdp_url: str = ""):
             else:
                 # --- LLM-based evaluation for other tasks ---
                 append_log("Asking LLM to evaluate the result...")
-                is_success = llm_handler.evaluate_operation(command, final_code, before_screenshot_path, after_screenshot_path)
+                is_success = fallback_llm_evaluate()
 
                 if is_success:
                     append_log("[SUCCESS] LLM evaluation: SUCCESS.")
@@ -290,7 +612,7 @@ def main_page():
     if st.button("▶️ Run Automation", use_container_width=True):
         if user_command:
             # Reset state for a new run
-            st.session_state.logs = ""
+            st.session_state.logs.clear()
             st.session_state.validation_pending = None
             with st.spinner("Automation in progress... Please wait."):
                 config = load_config()
@@ -308,7 +630,7 @@ def main_page():
                 append_log("[SUCCESS] User confirmed SUCCESS.")
                 pending_data = st.session_state.validation_pending
                 try:
-                    rag_handler = RAGHandler()
+                    rag_handler = get_rag_handler()
                     rag_handler.add_successful_automation(
                         st.session_state.abstract_prompt_for_saving,
                         pending_data['prompt'],
@@ -330,7 +652,7 @@ def main_page():
                 cleanup_temp_files(st.session_state.get("screenshots_to_cleanup", []))
                 st.session_state.validation_pending = None
 
-    st.code(st.session_state.logs, language="log")
+    st.code("\n".join(st.session_state.logs), language="log")
 
 
 def settings_page():
@@ -344,6 +666,11 @@ def settings_page():
         embedding_ollama_url = st.text_input("Ollama URL (for embedding model)", value=config.get('embedding_ollama_url'))
         operation_model = st.text_input("Operation Model", value=config.get('operation_model'))
         evaluation_model = st.text_input("Evaluation Model", value=config.get('evaluation_model'))
+        abstract_model = st.text_input(
+            "Abstract Model (Optional)",
+            value=config.get('abstract_model', ''),
+            help="Small text-only model for prompt abstraction (e.g. a 1-2B instruct model). Falls back to the Operation Model when empty."
+        )
         embedding_model = st.text_input("Embedding Model", value=config.get('embedding_model'))
         max_retries = st.number_input("Max Retries", min_value=1, max_value=10, value=config.get('max_retries', 3))
         cdp_url = st.text_input(
@@ -360,11 +687,17 @@ def settings_page():
                 "embedding_ollama_url": embedding_ollama_url,
                 "operation_model": operation_model,
                 "evaluation_model": evaluation_model,
+                "abstract_model": abstract_model,
                 "embedding_model": embedding_model,
                 "max_retries": max_retries,
                 "cdp_url": cdp_url
             }
             save_config(new_config)
+            # The cached handlers hold the old config; drop them so the next
+            # run reconnects with the new settings.
+            from llm_singleton import reset_llm_handler
+            reset_llm_handler()
+            get_rag_handler.clear()
             st.success("Settings saved successfully!")
 
 # --- App Entrypoint ---
@@ -373,14 +706,21 @@ if __name__ == "__main__":
 
     # Initialize session state first
     if 'logs' not in st.session_state:
-        st.session_state.logs = "Logs will appear here...\n"
+        st.session_state.logs = deque(["Logs will appear here..."], maxlen=1000)
 
     # Run setup
     setup_playwright()
 
+    # Warm heavy singletons concurrently; guard so reruns don't respawn it.
+    if 'prewarm_started' not in st.session_state:
+        st.session_state.prewarm_started = True
+        threading.Thread(target=_prewarm_handlers, daemon=True).start()
+
     st.sidebar.title("Navigation")
     page_options = ["Automation", "Settings"]
     page = st.sidebar.radio("Go to", page_options)
+    st.sidebar.checkbox("Show OCR visualization", key="show_ocr_viz",
+                        help="Draws OCR bounding boxes on the 'before' screenshot. Debugging aid; slows down each attempt.")
 
     if page == "Automation":
         main_page()
@@ -0,0 +1,137 @@
+"""
+Long-lived worker process for executing generated automation scripts.
+
+DeskAgent previously spawned a fresh Python interpreter per generated script,
+paying CPython startup plus the pyautogui/playwright import cost on every
+attempt. This worker is launched once by DesktopController and then receives
+length-prefixed UTF-8 code blocks over stdin, executing each in a fresh
+namespace on its own thread (so scripts that intentionally never finish, such
+as Playwright flows that keep the browser open, don't block later scripts).
+
+Protocol per script:
+    4 bytes  big-endian unsigned length N
+    N bytes  UTF-8 encoded Python source
+
+Each script's stdout/stderr go to script_output.log / script_error.log via a
+per-thread stream router, and script_done.flag is touched when it finishes,
+matching the contract the main app's crash detection and completion wait rely
+on.
+"""
+import struct
+import sys
+import threading
+import traceback
+
+OUTPUT_LOG = "script_output.log"
+ERROR_LOG = "script_error.log"
+DONE_FLAG = "script_done.flag"
+
+# Generation number of the most recently dispatched script. Only the current
+# generation owns the shared log files and done flag; the dispatch loop is the
+# sole writer, worker threads only read it.
+_generation = 0
+
+
+class _StreamRouter:
+    """
+    File-like proxy installed once on sys.stdout/sys.stderr.
+
+    contextlib.redirect_stdout swaps the *process-global* stream, which breaks
+    down with concurrent script threads: generated Playwright scripts park
+    forever on `await asyncio.Future()` by design, so a later script's redirect
+    nests inside the parked one — a late traceback from the parked script (say
+    the user closes the browser) lands in the *current* attempt's error log and
+    trips false crash detection, and a finishing script restores the parked
+    script's closed file objects. The router instead sends each write to the
+    log file registered by the calling thread, and drops writes from
+    superseded scripts, whose log files have been truncated and handed to the
+    current attempt. Threads that never registered (the dispatch loop) fall
+    through to the real stream.
+    """
+
+    def __init__(self, fallback):
+        self._fallback = fallback
+        self._local = threading.local()
+
+    def register(self, target, generation: int):
+        self._local.target = target
+        self._local.generation = generation
+
+    def _resolve(self):
+        target = getattr(self._local, 'target', None)
+        if target is None:
+            return self._fallback
+        if getattr(self._local, 'generation', -1) != _generation or target.closed:
+            return None
+        return target
+
+    def write(self, s):
+        target = self._resolve()
+        if target is not None:
+            try:
+                target.write(s)
+            except ValueError:
+                pass  # Target closed mid-write; drop the output.
+        return len(s)
+
+    def flush(self):
+        target = self._resolve()
+        if target is not None:
+            try:
+                target.flush()
+            except ValueError:
+                pass
+
+
+_stdout_router = _StreamRouter(sys.stdout)
+_stderr_router = _StreamRouter(sys.stderr)
+sys.stdout = _stdout_router
+sys.stderr = _stderr_router
+
+
+def _execute(code: str, generation: int):
+    """Runs one generated script, capturing output and signalling completion."""
+    # Line buffering: every write reaches the file while the router still
+    # vouches for it. A block-buffered handle would hold early output until
+    # close() and flush it into the truncated log of a later attempt.
+    out = open(OUTPUT_LOG, 'w', encoding='utf-8', buffering=1)
+    err = open(ERROR_LOG, 'w', encoding='utf-8', buffering=1)
+    _stdout_router.register(out, generation)
+    _stderr_router.register(err, generation)
+    try:
+        try:
+            exec(compile(code, '<generated_script>', 'exec'), {'__name__': '__main__'})
+        except SystemExit:
+            pass
+        except Exception:
+            traceback.print_exc()
+    finally:
+        out.close()
+        err.close()
+        # A superseded script that finally unparks must not signal completion
+        # for the attempt that is currently running.
+        if generation == _generation:
+            try:
+                with open(DONE_FLAG, 'w'):
+                    pass
+            except OSError:
+                pass
+
+
+def main():
+    global _generation
+    stdin = sys.stdin.buffer
+    while True:
+        header = stdin.read(4)
+        if len(header) < 4:
+            break  # Parent closed the pipe; shut down.
+        (length,) = struct.unpack('!I', header)
+        code = stdin.read(length).decode('utf-8')
+        _generation += 1
+        # Daemon threads: an endless script must not keep the worker alive
+        # after the parent exits.
+        threading.Thread(target=_execute, args=(code, _generation), daemon=True).start()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,10 +1,28 @@
 import argparse
+import asyncio
 import json
 import os
 import ollama
 from rag_handler import RAGHandler
 from llm_handler import LLMHandler
 
+async def _abstract_prompts(llm_handler, examples):
+    """
+    Abstracts the example prompts concurrently, bounded by a semaphore sized
+    from OLLAMA_NUM_PARALLEL so the Ollama server stays saturated but not
+    overloaded. Examples that ship their own abstract prompt skip the LLM.
+    """
+    sem = asyncio.Semaphore(int(os.environ.get('OLLAMA_NUM_PARALLEL', '4')))
+
+    async def abstract_one(example):
+        if "abstract_prompt" in example:
+            print(f"Using provided abstract prompt: {example['abstract_prompt']}")
+            return example["abstract_prompt"]
+        async with sem:
+            return await llm_handler.a_abstract_user_prompt(example["original_prompt"])
+
+    return await asyncio.gather(*(abstract_one(e) for e in examples))
+
 def build_rag_from_json(json_file):
     """
     Builds or rebuilds the RAG database from a JSON file of examples.
@@ -30,7 +48,7 @@ def build_rag_from_json(json_file):
 
         # We only need the LLM handler for the abstraction part,
         # and the RAG handler for the storage part.
-        llm_handler = LLMHandler()
+        llm_handler = LLMHandler(config=config)
         rag_handler = RAGHandler()
         print("Handlers initialized successfully.")
     except Exception as e:
@@ -47,35 +65,29 @@ def build_rag_from_json(json_file):
 
     print(f"Found {len(examples)} examples to add from '{json_file}'.\n")
 
+    valid_examples = []
     for i, example in enumerate(examples):
-        print(f"--- Processing Example {i+1} ---")
-        original_prompt = example.get("original_prompt", "")
-        code = example.get("code", "")
-
-        if not original_prompt or not code:
+        if not example.get("original_prompt") or not example.get("code"):
             print(f"Skipping example {i+1} due to missing 'original_prompt' or 'code'.")
             continue
+        valid_examples.append(example)
 
-        # Use the provided abstract prompt if it exists, otherwise generate it.
-        if "abstract_prompt" in example:
-            abstract_prompt = example["abstract_prompt"]
-            print(f"Using provided abstract prompt: {abstract_prompt}")
-        else:
-            print(f"Generating abstract prompt with LLM...")
-            abstract_prompt = llm_handler.abstract_user_prompt(original_prompt)
-
-        print(f"Original Prompt: {original_prompt}")
+    # The abstraction LLM calls are the dominant cost here; run them
+    # concurrently, then hand everything to the batch insert path so the
+    # index is embedded in batches and persisted once.
+    print(f"Abstracting {len(valid_examples)} prompt(s) concurrently...")
+    abstract_prompts = asyncio.run(_abstract_prompts(llm_handler, valid_examples))
 
-        try:
-            rag_handler.add_successful_automation(
-                abstract_prompt=abstract_prompt,
-                original_prompt=original_prompt,
-                python_code=code
-            )
-        except Exception as e:
-            print(f"Failed to add document to RAG index: {e}")
+    records = []
+    for example, abstract_prompt in zip(valid_examples, abstract_prompts):
+        print(f"Original Prompt: {example['original_prompt']}")
+        records.append({
+            "abstract_prompt": abstract_prompt,
+            "original_prompt": example["original_prompt"],
+            "python_code": example["code"],
+        })
 
-        print("-" * 20 + "\n")
+    rag_handler.add_successful_automations_batch(records)
 
     print("Finished building RAG database.")
     print("The vector_db directory should now be populated with the new examples.")
@@ -1,10 +1,16 @@
 import pyautogui
 import os
+import struct
 import subprocess
 import sys
+import threading
 from datetime import datetime
 from PIL import Image
 
+# Sentinel file touched when the launched automation script exits.
+# Allows the main app to wait on completion instead of sleeping blindly.
+SCRIPT_DONE_FLAG = "script_done.flag"
+
 class DesktopController:
     """
     Handles direct interactions with the desktop, such as taking screenshots,
@@ -16,8 +22,28 @@ class DesktopController:
         """
         self.screenshots_dir = screenshots_dir
         os.makedirs(self.screenshots_dir, exist_ok=True)
+        self._worker = None
         print(f"DesktopController initialized. Screenshots will be saved in '{self.screenshots_dir}'.")
 
+    def _get_worker(self) -> subprocess.Popen:
+        """
+        Returns the long-lived script worker process, starting (or restarting)
+        it if needed. Only the first call pays the interpreter startup and
+        library import cost; later scripts are just written to its stdin.
+        """
+        if self._worker is None or self._worker.poll() is not None:
+            worker_script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "automation_worker.py")
+            env = os.environ.copy()
+            env["PYTHONIOENCODING"] = "utf-8"
+            self._worker = subprocess.Popen(
+                [sys.executable, worker_script],
+                stdin=subprocess.PIPE,
+                env=env,
+                start_new_session=True
+            )
+            print(f"Launched automation worker with PID: {self._worker.pid}")
+        return self._worker
+
     def capture_screenshot(self) -> Image.Image:
         """
         Captures the entire screen and returns it as a PIL Image object.
@@ -27,23 +53,35 @@ class DesktopController:
         print("Screenshot captured successfully.")
         return screenshot
 
-    def save_screenshot(self, screenshot_image: Image.Image, prefix: str = "screenshot") -> str:
+    def save_screenshot(self, screenshot_image: Image.Image, prefix: str = "screenshot", fmt: str = "jpeg") -> str:
         """
         Saves a PIL Image object to a file with a timestamp.
 
+        JPEG is the default: for full-screen captures it encodes 5-10x faster
+        than PNG's deflate and produces 5-10x smaller files. Pass fmt='png'
+        for a lossless artifact when needed.
+
         Args:
             screenshot_image (Image.Image): The image to save.
             prefix (str): A prefix for the filename.
+            fmt (str): Output format, 'jpeg' (default) or 'png'.
 
         Returns:
             str: The path to the saved screenshot file.
         """
         timestamp = datetime.now().strftime("%Y%m%d_%H%M%S_%f")
-        filename = f"{prefix}_{timestamp}.png"
+        ext = "jpg" if fmt.lower() in ("jpeg", "jpg") else fmt.lower()
+        filename = f"{prefix}_{timestamp}.{ext}"
         filepath = os.path.join(self.screenshots_dir, filename)
 
         print(f"Saving screenshot to {filepath}...")
-        screenshot_image.save(filepath)
+        if ext == "jpg":
+            # Write through a 1 MB buffer so the encoder output is flushed in
+            # large sequential chunks rather than many small writes.
+            with open(filepath, 'wb', buffering=1 << 20) as f:
+                screenshot_image.convert('RGB').save(f, 'JPEG', quality=85, optimize=False, subsampling=1)
+        else:
+            screenshot_image.save(filepath)
         print("Screenshot saved successfully.")
         return filepath
 
@@ -60,53 +98,53 @@ class DesktopController:
 
     def execute_code(self, code: str):
         """
-        Executes a string of Python code in a separate process.
-        This is crucial for ensuring that `pyautogui` commands work correctly
-        and don't interfere with the main application. It also handles
-        non-ASCII characters correctly.
+        Executes a string of Python code in the long-lived worker process.
+        Running scripts out of process is crucial for ensuring that `pyautogui`
+        commands work correctly and don't interfere with the main application;
+        reusing one worker avoids the interpreter startup + heavy import cost
+        on every attempt.
 
         Args:
             code (str): The Python code to execute.
         """
         print(f"Executing code:\n---\n{code}\n---")
 
-        # Create a temporary file to store the code, ensuring UTF-8 encoding with BOM
-        # for compatibility with Windows and non-ASCII characters.
+        # Remove any stale completion flag and truncate the log files so the
+        # crash detection only ever sees output from this script.
+        try:
+            os.remove(SCRIPT_DONE_FLAG)
+        except FileNotFoundError:
+            pass
+        for log_path in ("script_output.log", "script_error.log"):
+            open(log_path, 'w', encoding='utf-8').close()
+
+        # Keep a copy of the script on disk as a debugging artifact, ensuring
+        # UTF-8 encoding with BOM for compatibility with Windows editors.
         temp_script_path = "temp_automation_script.py"
         try:
             with open(temp_script_path, 'w', encoding='utf-8-sig') as f:
                 f.write(code)
 
-            # Execute the script in a new, independent process
-            # Using sys.executable ensures we use the same Python interpreter.
-            # Setting PYTHONIOENCODING ensures stderr/stdout are handled correctly.
-            env = os.environ.copy()
-            env["PYTHONIOENCODING"] = "utf-8"
+            payload = code.encode('utf-8')
+            frame = struct.pack('!I', len(payload)) + payload
+            try:
+                worker = self._get_worker()
+                worker.stdin.write(frame)
+                worker.stdin.flush()
+            except (BrokenPipeError, OSError):
+                # The worker died mid-session; restart it once and retry.
+                print("Automation worker pipe broken; restarting worker...", file=sys.stderr)
+                self._worker = None
+                worker = self._get_worker()
+                worker.stdin.write(frame)
+                worker.stdin.flush()
 
-            # Execute the script in a new, non-blocking process using Popen
-            # This allows the main app to continue without waiting for the script to finish,
-            # which is essential for leaving browser windows open.
-            # Redirect stdout and stderr to log files to capture output from the detached process
-            with open("script_output.log", "w", encoding='utf-8') as stdout_log, \
-                 open("script_error.log", "w", encoding='utf-8') as stderr_log:
-                process = subprocess.Popen(
-                    [sys.executable, temp_script_path],
-                    stdout=stdout_log,
-                    stderr=stderr_log,
-                    env=env,
-                    start_new_session=True
-                )
-
-            # We don't wait for the process to complete here.
-            # The script will run independently as a detached process.
-            print(f"Launched script with PID: {process.pid}")
-            print("Execution command sent. The script will run independently.")
+            print("Execution command sent. The script will run in the worker process.")
 
         except Exception as e:
-            # This will catch errors related to launching the process itself.
-            # Errors from within the script will run in the background.
-            print(f"Error launching the script with Popen: {e}", file=sys.stderr)
+            # This will catch errors related to dispatching to the worker.
+            # Errors from within the script surface via script_error.log.
+            print(f"Error dispatching the script to the worker: {e}", file=sys.stderr)
             raise e
-        # The temporary script is NOT cleaned up here.
-        # It must persist for the subprocess to execute it.
-        # Cleanup should be handled by the main app flow after the operation is complete.
\ No newline at end of file
+        # The temporary script copy is NOT cleaned up here.
+        # Cleanup is handled by the main app flow after the operation is complete.
\ No newline at end of file
@@ -0,0 +1,101 @@
+"""
+Small on-disk response cache for LLM calls.
+
+Recurring desktop workflows ask the model the same thing against visually
+identical screens; a cache hit replaces an entire multi-second Ollama call.
+Entries are keyed on a digest of (model, prompts, screenshot hash) and expire
+after a TTL, with LRU eviction keeping the file bounded. The backing store is
+a plain JSON file beside the vector database, matching the abstraction cache.
+"""
+import hashlib
+import io
+import json
+import os
+import threading
+import time
+
+
+def screenshot_hash(screenshot) -> str:
+    """
+    Average-hash of a screenshot (file path or raw bytes): 8x8 grayscale
+    thresholded on its own mean, packed into a 64-bit hex string. Visually
+    equivalent screens map to the same hash even when the encoded bytes
+    differ, so re-runs against an unchanged desktop still hit the cache.
+    """
+    import numpy as np
+    from PIL import Image
+
+    source = io.BytesIO(screenshot) if isinstance(screenshot, (bytes, bytearray)) else screenshot
+    with Image.open(source) as img:
+        small = np.asarray(img.convert('L').resize((8, 8)), dtype=np.float32)
+    bits = (small > small.mean()).flatten()
+    return format(sum(1 << i for i, bit in enumerate(bits) if bit), '016x')
+
+
+def make_key(*parts: str) -> str:
+    """Builds a stable cache key from the given string components."""
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(part.encode('utf-8'))
+        digest.update(b'\x00')
+    return digest.hexdigest()
+
+
+class LLMCache:
+    """
+    JSON-file-backed LRU cache with per-entry TTL and hit/miss counters.
+    """
+    def __init__(self, cache_path: str = os.path.join("vector_db", "llm_cache.json"), max_entries: int = 256):
+        self.cache_path = cache_path
+        self.max_entries = max_entries
+        self._entries = {}
+        self._stats = {"hits": 0, "misses": 0}
+        # The cache is shared between the main thread's streaming generation
+        # and the speculative sample on the thread pool; the lock keeps
+        # concurrent set() calls from mutating _entries mid-serialization and
+        # from interleaving two writers on the cache file.
+        self._lock = threading.Lock()
+        try:
+            with open(self.cache_path, 'r', encoding='utf-8') as f:
+                self._entries = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            pass
+
+    def get(self, key: str):
+        """Returns the cached value, or None on a miss or an expired entry."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry["expires"] < time.time():
+                if entry is not None:
+                    del self._entries[key]
+                self._stats["misses"] += 1
+                return None
+            # Re-insert to mark the entry as most recently used (dicts keep
+            # insertion order, so the oldest entry is always first).
+            self._entries[key] = self._entries.pop(key)
+            self._stats["hits"] += 1
+            return entry["value"]
+
+    def set(self, key: str, value, ttl: float = 3600):
+        """Stores a value under the key, evicting the least recently used entries."""
+        with self._lock:
+            self._entries[key] = {"value": value, "expires": time.time() + ttl}
+            while len(self._entries) > self.max_entries:
+                self._entries.pop(next(iter(self._entries)))
+            self._save()
+
+    def stats(self) -> dict:
+        """Returns hit/miss counters for telemetry."""
+        with self._lock:
+            return dict(self._stats)
+
+    def _save(self):
+        """Persists the entries to disk. Callers must hold self._lock."""
+        try:
+            cache_dir = os.path.dirname(self.cache_path)
+            if cache_dir:
+                os.makedirs(cache_dir, exist_ok=True)
+            with open(self.cache_path, 'w', encoding='utf-8') as f:
+                json.dump(self._entries, f, ensure_ascii=False)
+        except OSError as e:
+            print(f"Could not persist LLM response cache: {e}")
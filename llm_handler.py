@@ -1,209 +1,690 @@
-import json
-import ollama
-from typing import Dict, Any, List
-
-class LLMHandler:
-    """
-    Handles all interactions with the Ollama server, including code generation,
-    evaluation, and embedding.
-    """
-    def __init__(self, config_path: str = "config.json"):
-        """
-        Initializes the Ollama client and caches system prompts.
-        """
-        with open(config_path, 'r') as f:
-            self.config = json.load(f)
-
-        self.ollama_url = self.config['ollama_url']
-        self.operation_model = self.config['operation_model']
-        self.evaluation_model = self.config['evaluation_model']
-        self.embedding_model = self.config['embedding_model']
-
-        self.client = ollama.Client(host=self.ollama_url)
-        self._initialize_prompts()
-        print("LLMHandler initialized. Connected to Ollama and prompts are cached.")
-
-    def _initialize_prompts(self):
-        """Caches the system prompts to avoid rebuilding them on every call."""
-        self.generation_system_prompt_template = """
-You are an expert Python programmer creating a script for desktop automation. Your code must be perfect, robust, and follow best practices.
-
-**1. Tool Selection**
-First, determine the correct tool for the job based on the user's prompt.
-- For **web browser** tasks (e.g., "Google", "website", "URL"), you **must** use the `playwright` library.
-- For **desktop applications** (e.g., "Notepad", "Calculator"), you **must** use `pyautogui`, `pygetwindow`, and `pyperclip`.
-
-**2. Desktop Automation Best Practices (`pyautogui`)**
-To ensure your script is reliable, follow this exact workflow:
-1.  **Check for Existing Window:** Before launching an app, always check if it's already open using `pygetwindow.getWindowsWithTitle('AppName')`.
-2.  **Activate or Launch:** If a window is found, you **must** use this sequence to ensure it is brought to the foreground: `window.minimize()`, `window.restore()`. Do not use `.activate()`. If no window is found, **and only then**, launch it with `subprocess.Popen(['app.exe'])`. After launching, you must wait (`time.sleep()`), get the window, and then use the same `minimize()`/`restore()` sequence.
-3.  **Typing Non-ASCII Text:** For any text that is not plain English (e.g., Japanese), you **must** use the clipboard method to avoid character corruption.
-    - **Required:** `import pyperclip` at the top of your script.
-    - **Required:** Use `pyperclip.copy('こんにちは')` followed by `pyautogui.hotkey('ctrl', 'v')`.
-4.  **Literal Values:** Never store literal text in a variable. Embed it directly in the function call (e.g., `pyperclip.copy('some_text')`).
-
-**3. Web Automation Best Practices (`playwright`)**
-To create a high-quality Playwright script, you must adhere to these rules:
-1.  **Async Boilerplate:** All scripts **must** begin with the standard `nest_asyncio` setup to prevent event loop conflicts.
-    ```python
-    import asyncio
-    import nest_asyncio
-    from playwright.async_api import async_playwright
-
-    nest_asyncio.apply()
-    ```
-2.  **Structure:** All your code must be within an `async def main()` function, called by `asyncio.run(main())`.
-3.  **Connecting to a Browser (CRITICAL):**
-    - **If a CDP URL is provided (e.g., `http://localhost:9222`)**: You **must** connect to the existing browser instance. Do NOT launch a new one. Use this exact code:
-      ```python
-      browser = await playwright.chromium.connect_over_cdp("{cdp_url}")
-      context = browser.contexts[0] # Assume the first context
-      page = context.pages[0]      # Assume the first page
-      ```
-    - **If NO CDP URL is provided**: You **must** launch a new browser. Use this exact code:
-      ```python
-      browser = await playwright.chromium.launch(headless=False)
-      context = await browser.new_context()
-      page = await context.new_page()
-      ```
-4.  **Selector Best Practices (CRITICAL):**
-    - **Google Search:** You **MUST** use `page.locator('textarea[name=\"q\"]')`. This is the most reliable selector based on dynamic verification.
-    - **Yahoo! JAPAN Search:** You **MUST** use `page.locator('[role=\"search\"] input[type=\"search\"]')`. This has also been dynamically verified as the most stable selector.
-    - **General Principle:** For other sites, prefer role-based locators (`get_by_role`, `get_by_label`) over fragile CSS or XPath selectors.
-5.  **Keep Browser Open:** To allow for verification, your script **must** end with `await asyncio.Future()`. This will keep the browser window open.
-6.  **Correct `await` Usage:** Remember that `await` is only for `async` functions. `page.get_by_role(...)` is NOT async. `await page.get_by_role(...)` is a `TypeError`. The correct pattern is `locator = page.get_by_role(...)` followed by `await locator.fill(...)`.
-
-**4. Final Output**
-- You **must** provide only the complete, executable Python code.
-- Ensure all necessary libraries (e.g., `pyperclip`, `pygetwindow`, `subprocess`) are imported.
-
-Screen Resolution: {width}x{height}.
-"""
-        self.evaluation_system_prompt = """
-You are a meticulous quality assurance expert. Your task is to determine if a desktop automation operation was successful by comparing "before" and "after" screenshots.
-
-Follow this **Chain of Thought** to make your determination:
-
-1.  **Analyze the User's Goal:** First, understand the user's original command. What was the core intent? (e.g., "type 'hello world'", "open the file menu", "search for 'cats'").
-
-2.  **Identify the Expected Outcome:** Based on the user's goal and the executed code, what is the single most important visual change you expect to see in the "after" screenshot?
-    *   *Example for typing:* "The text 'hello world' should appear in a text field."
-    *   *Example for clicking:* "A new menu, window, or button state should appear where the click occurred."
-    *   *Example for searching:* "The page should show search results related to 'cats'."
-
-3.  **Compare Screenshots for Evidence:** Look for the expected outcome in the "after" screenshot. Is there clear, unambiguous visual evidence that the goal was achieved? The "before" screenshot is for context.
-
-4.  **Final Judgment:** Based on your analysis, conclude with **only** the word "SUCCESS" or "FAILURE". Do not provide any other text or explanation. If the visual evidence is missing or ambiguous, you must conclude "FAILURE".
-"""
-        self.abstract_system_prompt = """
-You are an expert in summarizing user commands. Your task is to convert a specific user command into a general, abstract version.
-Focus on the *action* and the *type of target*, removing any specific, literal values like text, numbers, or file names.
-
-Examples:
-- User Command: "Click on the 'File' menu" -> Abstract Command: "Click on a menu item"
-- User Command: "Type 'Hello World' into the text editor" -> Abstract Command: "Type text into a text editor"
-- User Command: "Delete the file named 'report_2024.docx'" -> Abstract Command: "Delete a file"
-- User Command: "Move the mouse to coordinates 250, 500" -> Abstract Command: "Move the mouse to a coordinate"
-- User Command: "In the 'Sales' spreadsheet, enter '5000' in cell B2" -> Abstract Command: "Enter a value into a cell in a spreadsheet"
-
-Respond with only the abstract command.
-"""
-
-    def generate_automation_code(self, user_prompt: str, screen_size: tuple[int, int], screenshot_path: str, rag_examples: List[Dict[str, str]] = [], cdp_url: str = "") -> str:
-        """
-        Generates Python code for desktop automation using cached prompts.
-        """
-        width, height = screen_size
-        # Use .replace() for safe substitution to avoid KeyError if cdp_url is missing
-        system_prompt = self.generation_system_prompt_template.replace("{width}", str(width)).replace("{height}", str(height))
-
-        if cdp_url:
-            system_prompt = system_prompt.replace("{cdp_url}", cdp_url)
-        else:
-            # If no cdp_url is provided, we still need to remove the placeholder
-            # from the template to avoid it being interpreted by the LLM.
-            # We find the line with connect_over_cdp and the line after it to remove them.
-            lines = system_prompt.split('\n')
-            new_lines = []
-            skip_next = 0
-            for i, line in enumerate(lines):
-                if "connect_over_cdp(\"{cdp_url}\")" in line:
-                    # Mark the next 2 lines to be skipped as they are part of the CDP block
-                    skip_next = 3
-                if skip_next > 0:
-                    skip_next -= 1
-                    continue
-                new_lines.append(line)
-            system_prompt = "\n".join(new_lines)
-
-        full_prompt = ""
-        if rag_examples:
-            full_prompt += "Here are some examples of successful past operations. Use them as a reference for the correct format and style.\n\n"
-            for example in rag_examples:
-                full_prompt += f"User Command: {example['prompt']}\nCode:\n```python\n{example['code']}\n```\n\n"
-
-        full_prompt += f"Now, write a Python script that achieves the following goal.\nUser Command: {user_prompt}\nCode:\n"
-
-        try:
-            print(f"Generating code with model '{self.operation_model}' for prompt: {user_prompt}")
-            response = self.client.generate(
-                model=self.operation_model,
-                system=system_prompt,
-                prompt=full_prompt,
-                images=[screenshot_path],
+import asyncio
+import json
+import os
+import re
+from typing import Dict, Any, List
+
+# httpx and ollama are imported lazily in LLMHandler.__init__ so importing
+# this module (e.g. for LLMRateLimitError or the prompt constants) stays cheap.
+
+# Matches a leading ```python (or bare ```) fence or a trailing ``` fence,
+# so both can be stripped from an LLM response in a single pass.
+_FENCE_RE = re.compile(r"^\s*```(?:python)?\s*\n?|\n?```\s*$")
+
+# Matches a complete fenced block anywhere in the text, for responses that
+# wrap the code in explanatory prose despite the system prompt.
+_FENCED_BLOCK_RE = re.compile(r"```(?:python)?\s*\n(.*?)\n```", re.S)
+
+# System prompts are module-level constants: they are static apart from tiny
+# substitutions, and building them once keeps the bytes identical across calls
+# (which also lets Ollama's prefix KV cache hit).
+GENERATION_SYSTEM_PROMPT_TEMPLATE = """
+You are an expert Python programmer creating a script for desktop automation. Your code must be perfect, robust, and follow best practices.
+
+**1. Tool Selection**
+First, determine the correct tool for the job based on the user's prompt.
+- For **web browser** tasks (e.g., "Google", "website", "URL"), you **must** use the `playwright` library.
+- For **desktop applications** (e.g., "Notepad", "Calculator"), you **must** use `pyautogui`, `pygetwindow`, and `pyperclip`.
+
+**2. Desktop Automation Best Practices (`pyautogui`)**
+To ensure your script is reliable, follow this exact workflow:
+1.  **Check for Existing Window:** Before launching an app, always check if it's already open using `pygetwindow.getWindowsWithTitle('AppName')`.
+2.  **Activate or Launch:** If a window is found, you **must** use this sequence to ensure it is brought to the foreground: `window.minimize()`, `window.restore()`. Do not use `.activate()`. If no window is found, **and only then**, launch it with `subprocess.Popen(['app.exe'])`. After launching, you must wait (`time.sleep()`), get the window, and then use the same `minimize()`/`restore()` sequence.
+3.  **Typing Non-ASCII Text:** For any text that is not plain English (e.g., Japanese), you **must** use the clipboard method to avoid character corruption.
+    - **Required:** `import pyperclip` at the top of your script.
+    - **Required:** Use `pyperclip.copy('こんにちは')` followed by `pyautogui.hotkey('ctrl', 'v')`.
+4.  **Literal Values:** Never store literal text in a variable. Embed it directly in the function call (e.g., `pyperclip.copy('some_text')`).
+
+**3. Web Automation Best Practices (`playwright`)**
+To create a high-quality Playwright script, you must adhere to these rules:
+1.  **Async Boilerplate:** All scripts **must** begin with the standard `nest_asyncio` setup to prevent event loop conflicts.
+    ```python
+    import asyncio
+    import nest_asyncio
+    from playwright.async_api import async_playwright
+
+    nest_asyncio.apply()
+    ```
+2.  **Structure:** All your code must be within an `async def main()` function, called by `asyncio.run(main())`.
+3.  **Connecting to a Browser (CRITICAL):**
+    - **If a CDP URL is provided (e.g., `http://localhost:9222`)**: You **must** connect to the existing browser instance. Do NOT launch a new one. Use this exact code:
+      ```python
+      browser = await playwright.chromium.connect_over_cdp("{cdp_url}")
+      context = browser.contexts[0] # Assume the first context
+      page = context.pages[0]      # Assume the first page
+      ```
+    - **If NO CDP URL is provided**: You **must** launch a new browser. Use this exact code:
+      ```python
+      browser = await playwright.chromium.launch(headless=False)
+      context = await browser.new_context()
+      page = await context.new_page()
+      ```
+4.  **Selector Best Practices (CRITICAL):**
+    - **Google Search:** You **MUST** use `page.locator('textarea[name=\"q\"]')`. This is the most reliable selector based on dynamic verification.
+    - **Yahoo! JAPAN Search:** You **MUST** use `page.locator('[role=\"search\"] input[type=\"search\"]')`. This has also been dynamically verified as the most stable selector.
+    - **General Principle:** For other sites, prefer role-based locators (`get_by_role`, `get_by_label`) over fragile CSS or XPath selectors.
+5.  **Keep Browser Open:** To allow for verification, your script **must** end with `await asyncio.Future()`. This will keep the browser window open.
+6.  **Correct `await` Usage:** Remember that `await` is only for `async` functions. `page.get_by_role(...)` is NOT async. `await page.get_by_role(...)` is a `TypeError`. The correct pattern is `locator = page.get_by_role(...)` followed by `await locator.fill(...)`.
+
+**4. Final Output**
+- You **must** provide only the complete, executable Python code.
+- Ensure all necessary libraries (e.g., `pyperclip`, `pygetwindow`, `subprocess`) are imported.
+
+Screen Resolution: {width}x{height}.
+"""
+
+EVALUATION_SYSTEM_PROMPT = """
+You are a meticulous quality assurance expert. Your task is to determine if a desktop automation operation was successful by comparing "before" and "after" screenshots. They are provided as a single side-by-side image: the screen BEFORE the operation is on the left, the screen AFTER the operation is on the right (each half is labeled).
+
+Follow this **Chain of Thought** to make your determination:
+
+1.  **Analyze the User's Goal:** First, understand the user's original command. What was the core intent? (e.g., "type 'hello world'", "open the file menu", "search for 'cats'").
+
+2.  **Identify the Expected Outcome:** Based on the user's goal and the executed code, what is the single most important visual change you expect to see in the "after" screenshot?
+    *   *Example for typing:* "The text 'hello world' should appear in a text field."
+    *   *Example for clicking:* "A new menu, window, or button state should appear where the click occurred."
+    *   *Example for searching:* "The page should show search results related to 'cats'."
+
+3.  **Compare Screenshots for Evidence:** Look for the expected outcome in the "after" screenshot. Is there clear, unambiguous visual evidence that the goal was achieved? The "before" screenshot is for context.
+
+4.  **Final Judgment:** Based on your analysis, conclude with **only** the word "SUCCESS" or "FAILURE". Do not provide any other text or explanation. If the visual evidence is missing or ambiguous, you must conclude "FAILURE".
+"""
+
+ABSTRACT_SYSTEM_PROMPT = """
+You are an expert in summarizing user commands. Your task is to convert a specific user command into a general, abstract version.
+Focus on the *action* and the *type of target*, removing any specific, literal values like text, numbers, or file names.
+
+Examples:
+- User Command: "Click on the 'File' menu" -> Abstract Command: "Click on a menu item"
+- User Command: "Type 'Hello World' into the text editor" -> Abstract Command: "Type text into a text editor"
+- User Command: "Delete the file named 'report_2024.docx'" -> Abstract Command: "Delete a file"
+- User Command: "Move the mouse to coordinates 250, 500" -> Abstract Command: "Move the mouse to a coordinate"
+- User Command: "In the 'Sales' spreadsheet, enter '5000' in cell B2" -> Abstract Command: "Enter a value into a cell in a spreadsheet"
+
+Respond with only the abstract command.
+"""
+
+
+class LLMRateLimitError(Exception):
+    """Raised when the Ollama server rejects a request because it is overloaded."""
+
+
+class LLMHandler:
+    """
+    Handles all interactions with the Ollama server, including code generation,
+    evaluation, and embedding.
+    """
+    def __init__(self, config: Dict = None, config_path: str = "config.json"):
+        """
+        Initializes the Ollama client and caches system prompts.
+
+        Args:
+            config (Dict): An already-parsed configuration dict. Passing one
+                           avoids re-reading config.json when the caller has
+                           it loaded anyway.
+            config_path (str): Path to the config file, used when no dict is given.
+        """
+        import httpx
+        import ollama
+
+        if config is not None:
+            self.config = config
+        else:
+            with open(config_path, 'r') as f:
+                self.config = json.load(f)
+
+        self.ollama_url = self.config['ollama_url']
+        self.operation_model = self.config['operation_model']
+        # Abstraction is a trivial text rewrite; a small text-only model via
+        # the optional 'abstract_model' key is >10x faster than running it
+        # through the big vision/code model.
+        self.abstract_model = self.config.get('abstract_model') or self.config['operation_model']
+        self.evaluation_model = self.config['evaluation_model']
+        self.embedding_model = self.config['embedding_model']
+
+        # Keep a warm connection pool to the Ollama server: each attempt makes
+        # up to three round-trips (abstract, generate, evaluate), and reusing
+        # sockets avoids a TCP handshake per call. Extra kwargs are forwarded
+        # to the underlying httpx.Client.
+        self.client = ollama.Client(
+            host=self.ollama_url,
+            limits=httpx.Limits(max_keepalive_connections=8, keepalive_expiry=300),
+            # Long generations on a cold model can exceed httpx's 5s default.
+            timeout=600,
+        )
+        # Async twin of the client for callers that overlap independent LLM
+        # calls (requires OLLAMA_NUM_PARALLEL > 1 on the server to run truly
+        # in parallel).
+        self.aclient = ollama.AsyncClient(
+            host=self.ollama_url,
+            limits=httpx.Limits(max_keepalive_connections=8, keepalive_expiry=300),
+            timeout=600,
+        )
+        self._initialize_prompts()
+        self._load_abstract_cache()
+        # Response cache for code generation: a hit on a recurring command
+        # against a visually identical screen skips the Ollama call entirely.
+        # (Prompt abstraction has its own dedicated cache.)
+        from llm_cache import LLMCache
+        self._response_cache = LLMCache()
+        print("LLMHandler initialized. Connected to Ollama and prompts are cached.")
+
+    def _load_abstract_cache(self):
+        """
+        Loads the persistent prompt-abstraction cache. Abstraction is
+        deterministic by intent, so repeated commands can skip the Ollama
+        round-trip entirely, across process restarts.
+        """
+        self._abstract_cache_path = os.path.join("vector_db", "abstract_cache.json")
+        self._abstract_cache = {}
+        try:
+            with open(self._abstract_cache_path, 'r', encoding='utf-8') as f:
+                self._abstract_cache = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            pass
+
+    def _save_abstract_cache(self):
+        """Persists the abstraction cache, evicting the oldest entry when full."""
+        while len(self._abstract_cache) > 1024:
+            self._abstract_cache.pop(next(iter(self._abstract_cache)))
+        try:
+            os.makedirs(os.path.dirname(self._abstract_cache_path), exist_ok=True)
+            with open(self._abstract_cache_path, 'w', encoding='utf-8') as f:
+                json.dump(self._abstract_cache, f, ensure_ascii=False, indent=2)
+        except OSError as e:
+            print(f"Could not persist abstraction cache: {e}")
+
+    def _initialize_prompts(self):
+        """Caches references to the system prompts and the per-resolution cache."""
+        self.generation_system_prompt_template = GENERATION_SYSTEM_PROMPT_TEMPLATE
+        self.evaluation_system_prompt = EVALUATION_SYSTEM_PROMPT
+        self.abstract_system_prompt = ABSTRACT_SYSTEM_PROMPT
+        # Fully-built generation system prompts, keyed by (screen_size, cdp_url).
+        # Screen size and CDP endpoint rarely change within a session, so the
+        # string build + CDP-block surgery runs once instead of per call.
+        self._sys_prompt_cache = {}
+
+    def _build_system_prompt(self, screen_size: tuple[int, int], cdp_url: str) -> str:
+        """Renders (and caches) the generation system prompt for a screen size and CDP URL."""
+        cache_key = (screen_size, cdp_url)
+        cached = self._sys_prompt_cache.get(cache_key)
+        if cached is not None:
+            return cached
+
+        width, height = screen_size
+        # Use .replace() for safe substitution to avoid KeyError if cdp_url is missing
+        system_prompt = self.generation_system_prompt_template.replace("{width}", str(width)).replace("{height}", str(height))
+
+        if cdp_url:
+            system_prompt = system_prompt.replace("{cdp_url}", cdp_url)
+        else:
+            # If no cdp_url is provided, we still need to remove the placeholder
+            # from the template to avoid it being interpreted by the LLM.
+            # We find the line with connect_over_cdp and the line after it to remove them.
+            lines = system_prompt.split('\n')
+            new_lines = []
+            skip_next = 0
+            for i, line in enumerate(lines):
+                if "connect_over_cdp(\"{cdp_url}\")" in line:
+                    # Mark the next 2 lines to be skipped as they are part of the CDP block
+                    skip_next = 3
+                if skip_next > 0:
+                    skip_next -= 1
+                    continue
+                new_lines.append(line)
+            system_prompt = "\n".join(new_lines)
+
+        self._sys_prompt_cache[cache_key] = system_prompt
+        return system_prompt
+
+    def warm_generation_cache(self, screen_size: tuple[int, int], cdp_url: str = ""):
+        """
+        Prefills Ollama's prefix KV cache for the generation system prompt.
+        An empty user prompt makes the server tokenize and cache the long
+        static prefix once; later generation calls send the byte-identical
+        system prompt and reuse the cached K/V state instead of re-paying
+        hundreds of tokens of prefill.
+        """
+        try:
+            system_prompt = self._build_system_prompt(screen_size, cdp_url)
+            self.client.generate(
+                model=self.operation_model,
+                system=system_prompt,
+                prompt="",
+                options={'keep_alive': -1, 'num_predict': 1}
+            )
+            if self.abstract_model != self.operation_model:
+                # Make the dedicated abstraction model resident too.
+                self.client.generate(
+                    model=self.abstract_model,
+                    system=self.abstract_system_prompt,
+                    prompt="",
+                    options={'keep_alive': -1, 'num_predict': 1}
+                )
+            print("Generation system prompt KV cache warmed.")
+        except Exception as e:
+            print(f"Could not warm generation KV cache: {e}")
+
+    def _build_generation_request(self, user_prompt: str, screen_size: tuple[int, int], rag_examples: List[Dict[str, str]], cdp_url: str, temperature: float):
+        """Builds the (system_prompt, full_prompt, options) tuple for code generation."""
+        system_prompt = self._build_system_prompt(screen_size, cdp_url)
+
+        # The few-shot examples ride in the system field, keeping the user
+        # prompt short and identical across retries of the same command —
+        # which preserves Ollama's prefix KV cache. Examples are ordered by
+        # similarity ascending so the best match sits adjacent to the user
+        # command, maximizing the shared prefix across similar queries.
+        if rag_examples:
+            example_block = "\n\n# EXAMPLES\nHere are some examples of successful past operations. Use them as a reference for the correct format and style.\n\n"
+            for example in reversed(rag_examples):
+                example_block += f"User Command: {example['prompt']}\nCode:\n```python\n{example['code']}\n```\n\n"
+            system_prompt = system_prompt + example_block
+
+        full_prompt = f"Now, write a Python script that achieves the following goal.\nUser Command: {user_prompt}\nCode:\n"
+
+        # num_keep=-1 pins the system tokens on context shifts.
+        options = {'keep_alive': -1, 'num_keep': -1}
+        if temperature is not None:
+            options['temperature'] = temperature
+
+        return system_prompt, full_prompt, options
+
+    @staticmethod
+    def _prepare_image(screenshot: Any, max_edge: int = 1344) -> Any:
+        """
+        Normalizes a screenshot argument for the vision payload. Raw bytes
+        pass through untouched (the app already encodes downscaled JPEG);
+        file paths are loaded, downscaled to the model's working resolution
+        and re-encoded as JPEG, so a full-resolution file never goes over
+        the wire. Returns the argument unchanged on any error.
+        """
+        if isinstance(screenshot, (bytes, bytearray)):
+            return screenshot
+        try:
+            import io
+            from PIL import Image
+            with Image.open(screenshot) as img:
+                rgb = img.convert('RGB')
+            rgb.thumbnail((max_edge, max_edge), Image.LANCZOS)
+            buf = io.BytesIO()
+            rgb.save(buf, format='JPEG', quality=85)
+            return buf.getvalue()
+        except Exception as e:
+            print(f"Could not pre-encode screenshot ({e}); sending as-is.")
+            return screenshot
+
+    def _generation_cache_key(self, system_prompt: str, full_prompt: str, screenshot: Any, temperature: float) -> str:
+        """
+        Builds the response-cache key for a generation request, or returns
+        None if the screenshot cannot be hashed (the call then just runs
+        uncached). The temperature is part of the key so samples drawn at
+        different temperatures (e.g. the speculative 0.8 sample and the
+        primary 0.2 stream) don't overwrite each other's entries.
+        """
+        import llm_cache
+        try:
+            return llm_cache.make_key(
+                self.operation_model, system_prompt, full_prompt,
+                repr(temperature), llm_cache.screenshot_hash(screenshot))
+        except Exception as e:
+            print(f"Response cache key computation failed: {e}")
+            return None
+
+    @staticmethod
+    def _clean_generated_code(raw_response: str) -> str:
+        """
+        Strips the markdown code fence from a raw LLM response in one regex
+        pass. If fences remain afterwards the model wrapped the code in
+        prose; in that case the first complete fenced block is extracted.
+        """
+        stripped = _FENCE_RE.sub('', raw_response).strip()
+        if '```' in stripped:
+            match = _FENCED_BLOCK_RE.search(raw_response)
+            if match:
+                return match.group(1).strip()
+        return stripped
+
+    @staticmethod
+    def _handle_generation_error(e: Exception) -> str:
+        """Shared error handling for the sync and async generation paths."""
+        # Surface overload errors distinctly so the caller can apply a
+        # longer, jittered backoff instead of burning its retry budget.
+        if getattr(e, 'status_code', None) in (429, 503):
+            raise LLMRateLimitError(str(e)) from e
+        print(f"Error generating code from Ollama: {e}")
+        return ""
+
+    def generate_automation_code(self, user_prompt: str, screen_size: tuple[int, int], screenshot: Any, rag_examples: List[Dict[str, str]] = [], cdp_url: str = "", temperature: float = None, read_cache: bool = True) -> str:
+        """
+        Generates Python code for desktop automation using cached prompts.
+
+        `screenshot` may be a file path or raw image bytes; the Ollama client
+        accepts both, so callers can skip the disk round-trip entirely.
+        Pass `read_cache=False` to force a fresh sample (retries after a
+        failed attempt must not replay the cached failing code); the fresh
+        result still replaces the cached entry.
+        """
+        system_prompt, full_prompt, options = self._build_generation_request(
+            user_prompt, screen_size, rag_examples, cdp_url, temperature)
+
+        cache_key = self._generation_cache_key(system_prompt, full_prompt, screenshot, temperature)
+        if cache_key and read_cache:
+            cached = self._response_cache.get(cache_key)
+            if cached is not None:
+                print(f"Response cache hit for prompt: {user_prompt}")
+                return cached
+
+        try:
+            print(f"Generating code with model '{self.operation_model}' for prompt: {user_prompt}")
+            text = ""
+            for chunk in self.client.generate(
+                model=self.operation_model,
+                system=system_prompt,
+                prompt=full_prompt,
+                images=[self._prepare_image(screenshot)],
+                options=options,
+                stream=True
+            ):
+                text += chunk['response']
+                if self._saw_closing_fence(text):
+                    break
+
+            generated_code = self._clean_generated_code(text)
+            print(f"Generated Code:\n{generated_code}")
+            if cache_key and generated_code:
+                self._response_cache.set(cache_key, generated_code)
+            return generated_code
+        except Exception as e:
+            return self._handle_generation_error(e)
+
+    @staticmethod
+    def _saw_closing_fence(text: str) -> bool:
+        """
+        True once the generated text contains a closed code fence. Models
+        often keep emitting commentary after the code block; breaking out of
+        the stream at this point closes the connection, which cancels the
+        remaining decode work on the server.
+        """
+        return text.count('```') >= 2
+
+    def generate_automation_code_stream(self, user_prompt: str, screen_size: tuple[int, int], screenshot: Any, rag_examples: List[Dict[str, str]] = [], cdp_url: str = "", temperature: float = None, read_cache: bool = True):
+        """
+        Streaming variant of `generate_automation_code`: yields raw response
+        chunks as the model produces them, so the caller can render partial
+        code immediately instead of waiting for the full script. The caller
+        should strip the code fence from the joined chunks once the stream
+        ends (see `_clean_generated_code`). `read_cache=False` forces a
+        fresh sample, as in `generate_automation_code`.
+        """
+        system_prompt, full_prompt, options = self._build_generation_request(
+            user_prompt, screen_size, rag_examples, cdp_url, temperature)
+
+        cache_key = self._generation_cache_key(system_prompt, full_prompt, screenshot, temperature)
+        if cache_key and read_cache:
+            cached = self._response_cache.get(cache_key)
+            if cached is not None:
+                print(f"Response cache hit for prompt: {user_prompt}")
+                yield cached
+                return
+
+        print(f"Streaming code generation with model '{self.operation_model}' for prompt: {user_prompt}")
+        chunks = []
+        try:
+            for chunk in self.client.generate(
+                model=self.operation_model,
+                system=system_prompt,
+                prompt=full_prompt,
+                images=[self._prepare_image(screenshot)],
+                options=options,
+                stream=True
+            ):
+                chunks.append(chunk['response'])
+                yield chunk['response']
+                if self._saw_closing_fence("".join(chunks)):
+                    break
+        except Exception as e:
+            # Ends the stream on ordinary errors; overload errors propagate
+            # as LLMRateLimitError so the caller can back off.
+            self._handle_generation_error(e)
+            return
+        generated_code = self._clean_generated_code("".join(chunks))
+        if cache_key and generated_code:
+            self._response_cache.set(cache_key, generated_code)
+
+    async def a_generate_automation_code(self, user_prompt: str, screen_size: tuple[int, int], screenshot: Any, rag_examples: List[Dict[str, str]] = [], cdp_url: str = "", temperature: float = None, read_cache: bool = True) -> str:
+        """
+        Async variant of `generate_automation_code`, for overlapping the call
+        with other work via asyncio.
+        """
+        system_prompt, full_prompt, options = self._build_generation_request(
+            user_prompt, screen_size, rag_examples, cdp_url, temperature)
+
+        cache_key = self._generation_cache_key(system_prompt, full_prompt, screenshot, temperature)
+        if cache_key and read_cache:
+            cached = self._response_cache.get(cache_key)
+            if cached is not None:
+                print(f"Response cache hit for prompt: {user_prompt}")
+                return cached
+
+        try:
+            print(f"Generating code with model '{self.operation_model}' for prompt: {user_prompt}")
+            response = await self.aclient.generate(
+                model=self.operation_model,
+                system=system_prompt,
+                prompt=full_prompt,
+                images=[self._prepare_image(screenshot)],
+                options=options
+            )
+
+            generated_code = self._clean_generated_code(response['response'])
+            print(f"Generated Code:\n{generated_code}")
+            if cache_key and generated_code:
+                self._response_cache.set(cache_key, generated_code)
+            return generated_code
+        except Exception as e:
+            return self._handle_generation_error(e)
+
+    @staticmethod
+    def _screens_effectively_identical(before_screenshot: Any, after_screenshot: Any, threshold: float = 2.0) -> bool:
+        """
+        Fast pixel-difference pre-check on two screenshots (file paths or raw
+        bytes). Returns True when the frames are visually indistinguishable —
+        in which case the operation obviously had no effect and the
+        multi-second vision LLM call can be skipped. Any error (unreadable
+        image, missing numpy) returns False so the real evaluation runs.
+        """
+        try:
+            import io
+
+            import numpy as np
+            from PIL import Image
+
+            def _load(screenshot):
+                source = io.BytesIO(screenshot) if isinstance(screenshot, (bytes, bytearray)) else screenshot
+                with Image.open(source) as img:
+                    return np.asarray(img.convert('L').resize((256, 256)), dtype=np.int16)
+
+            diff = np.abs(_load(after_screenshot) - _load(before_screenshot)).mean()
+        except Exception as e:
+            print(f"Pixel-diff pre-check failed ({e}); falling through to LLM evaluation.")
+            return False
+        return diff < threshold
+
+    @staticmethod
+    def _montage(before_screenshot: Any, after_screenshot: Any) -> Any:
+        """
+        Builds one labeled side-by-side JPEG from the before/after
+        screenshots (paths or bytes). Vision models push each image through
+        the ViT separately, so a single montage means one forward pass and
+        half the upload. Returns None on any error so the caller can fall
+        back to sending the two images separately.
+        """
+        try:
+            import io
+            from PIL import Image, ImageDraw
+
+            def _load(screenshot):
+                source = io.BytesIO(screenshot) if isinstance(screenshot, (bytes, bytearray)) else screenshot
+                return Image.open(source).convert('RGB')
+
+            before_img = _load(before_screenshot)
+            after_img = _load(after_screenshot)
+            # A shared height keeps the halves comparable; 720px is plenty
+            # for the model while halving pixel count vs. two full frames.
+            height = min(before_img.height, after_img.height, 720)
+            before_img = before_img.resize((round(before_img.width * height / before_img.height), height), Image.LANCZOS)
+            after_img = after_img.resize((round(after_img.width * height / after_img.height), height), Image.LANCZOS)
+
+            label_height = 28
+            canvas = Image.new('RGB', (before_img.width + after_img.width + 20, height + label_height), 'white')
+            canvas.paste(before_img, (0, label_height))
+            canvas.paste(after_img, (before_img.width + 20, label_height))
+            draw = ImageDraw.Draw(canvas)
+            draw.text((4, 4), "BEFORE", fill='black')
+            draw.text((before_img.width + 24, 4), "AFTER", fill='black')
+
+            buf = io.BytesIO()
+            canvas.save(buf, format='JPEG', quality=85, subsampling=1)
+            return buf.getvalue()
+        except Exception as e:
+            print(f"Could not build evaluation montage ({e}); sending images separately.")
+            return None
+
+    def evaluate_operation(self, user_prompt: str, executed_code: str, before_screenshot: Any, after_screenshot: Any) -> bool:
+        """
+        Evaluates if the operation was successful using a cached prompt.
+
+        The screenshots may be file paths or raw image bytes. A cheap
+        pixel-diff pre-check short-circuits to FAILURE when the screen did
+        not visibly change, skipping the vision model call entirely.
+        """
+        if self._screens_effectively_identical(before_screenshot, after_screenshot):
+            print("Pixel-diff pre-check: screens are effectively identical. Evaluating as FAILURE without LLM call.")
+            return False
+
+        print("Evaluating operation with LLM...")
+        prompt = f"User Command: {user_prompt}\nExecuted Code:\n```python\n{executed_code}\n```"
+
+        montage = self._montage(before_screenshot, after_screenshot)
+        if montage is not None:
+            images = [montage]
+        else:
+            images = [self._prepare_image(before_screenshot), self._prepare_image(after_screenshot)]
+
+        try:
+            response = self.client.generate(
+                model=self.evaluation_model,
+                system=self.evaluation_system_prompt,
+                prompt=prompt,
+                images=images,
                 options={'keep_alive': -1}
-            )
-
-            generated_code = response['response'].strip()
-            if generated_code.startswith("```python"):
-                generated_code = generated_code[len("```python"):].strip()
-            if generated_code.endswith("```"):
-                generated_code = generated_code[:-len("```")].strip()
-
-            print(f"Generated Code:\n{generated_code}")
-            return generated_code
-        except Exception as e:
-            print(f"Error generating code from Ollama: {e}")
-            return ""
-
-    def evaluate_operation(self, user_prompt: str, executed_code: str, before_screenshot_path: str, after_screenshot_path: str) -> bool:
-        """
-        Evaluates if the operation was successful using a cached prompt.
-        """
-        print("Evaluating operation with LLM...")
-        prompt = f"User Command: {user_prompt}\nExecuted Code:\n```python\n{executed_code}\n```"
-
-        try:
-            response = self.client.generate(
-                model=self.evaluation_model,
-                system=self.evaluation_system_prompt,
-                prompt=prompt,
-                images=[before_screenshot_path, after_screenshot_path],
+            )
+
+            result = response['response'].strip().upper()
+            print(f"LLM Evaluation Result: {result}")
+            return "SUCCESS" in result
+        except Exception as e:
+            print(f"Error during LLM evaluation: {e}")
+            return False
+
+    async def a_evaluate_operation(self, user_prompt: str, executed_code: str, before_screenshot: Any, after_screenshot: Any) -> bool:
+        """Async variant of `evaluate_operation`."""
+        if self._screens_effectively_identical(before_screenshot, after_screenshot):
+            print("Pixel-diff pre-check: screens are effectively identical. Evaluating as FAILURE without LLM call.")
+            return False
+
+        print("Evaluating operation with LLM...")
+        prompt = f"User Command: {user_prompt}\nExecuted Code:\n```python\n{executed_code}\n```"
+
+        montage = self._montage(before_screenshot, after_screenshot)
+        if montage is not None:
+            images = [montage]
+        else:
+            images = [self._prepare_image(before_screenshot), self._prepare_image(after_screenshot)]
+
+        try:
+            response = await self.aclient.generate(
+                model=self.evaluation_model,
+                system=self.evaluation_system_prompt,
+                prompt=prompt,
+                images=images,
                 options={'keep_alive': -1}
-            )
-
-            result = response['response'].strip().upper()
-            print(f"LLM Evaluation Result: {result}")
-            return "SUCCESS" in result
-        except Exception as e:
-            print(f"Error during LLM evaluation: {e}")
-            return False
-
-    def abstract_user_prompt(self, user_prompt: str) -> str:
-        """
-        Uses an LLM to convert a specific user prompt into a generalized version, using a cached prompt.
-        """
-        print(f"Abstracting user prompt: {user_prompt}")
-        try:
-            response = self.client.generate(
-                model=self.operation_model,
-                system=self.abstract_system_prompt,
+            )
+
+            result = response['response'].strip().upper()
+            print(f"LLM Evaluation Result: {result}")
+            return "SUCCESS" in result
+        except Exception as e:
+            print(f"Error during LLM evaluation: {e}")
+            return False
+
+    async def a_evaluate_and_abstract(self, user_prompt: str, executed_code: str, before_screenshot: Any, after_screenshot: Any):
+        """
+        Runs result evaluation and prompt abstraction concurrently. The two
+        calls are independent — evaluation looks at screenshots and code,
+        abstraction only at the user prompt — so overlapping them halves the
+        wall time when the Ollama server has headroom (OLLAMA_NUM_PARALLEL
+        must be > 1 for true parallelism).
+
+        Returns:
+            tuple[bool, str]: (evaluation result, abstracted prompt).
+        """
+        return await asyncio.gather(
+            self.a_evaluate_operation(user_prompt, executed_code, before_screenshot, after_screenshot),
+            self.a_abstract_user_prompt(user_prompt),
+        )
+
+    def abstract_user_prompt(self, user_prompt: str) -> str:
+        """
+        Uses an LLM to convert a specific user prompt into a generalized version, using a cached prompt.
+        Results are memoized (and persisted) keyed on the normalized prompt.
+        """
+        cache_key = user_prompt.strip().lower()
+        cached = self._abstract_cache.get(cache_key)
+        if cached:
+            print(f"Abstraction cache hit for prompt: {user_prompt}")
+            return cached
+
+        print(f"Abstracting user prompt: {user_prompt}")
+        try:
+            # Short deterministic output: abstract commands are one line, and
+            # temperature 0 keeps repeated prompts cache-friendly.
+            response = self.client.generate(
+                model=self.abstract_model,
+                system=self.abstract_system_prompt,
                 prompt=user_prompt,
-                options={'keep_alive': -1}
-            )
-            abstracted_prompt = response['response'].strip()
-            print(f"Abstracted Prompt: {abstracted_prompt}")
-            return abstracted_prompt
-        except Exception as e:
-            print(f"Error abstracting prompt: {e}. Falling back to original prompt.")
+                options={'keep_alive': -1, 'num_predict': 32, 'temperature': 0.0}
+            )
+            abstracted_prompt = response['response'].strip()
+            print(f"Abstracted Prompt: {abstracted_prompt}")
+            self._abstract_cache[cache_key] = abstracted_prompt
+            self._save_abstract_cache()
+            return abstracted_prompt
+        except Exception as e:
+            print(f"Error abstracting prompt: {e}. Falling back to original prompt.")
+            return user_prompt
+
+    async def a_abstract_user_prompt(self, user_prompt: str) -> str:
+        """Async variant of `abstract_user_prompt`."""
+        cache_key = user_prompt.strip().lower()
+        cached = self._abstract_cache.get(cache_key)
+        if cached:
+            print(f"Abstraction cache hit for prompt: {user_prompt}")
+            return cached
+
+        print(f"Abstracting user prompt: {user_prompt}")
+        try:
+            response = await self.aclient.generate(
+                model=self.abstract_model,
+                system=self.abstract_system_prompt,
+                prompt=user_prompt,
+                options={'keep_alive': -1, 'num_predict': 32, 'temperature': 0.0}
+            )
+            abstracted_prompt = response['response'].strip()
+            print(f"Abstracted Prompt: {abstracted_prompt}")
+            self._abstract_cache[cache_key] = abstracted_prompt
+            self._save_abstract_cache()
+            return abstracted_prompt
+        except Exception as e:
+            print(f"Error abstracting prompt: {e}. Falling back to original prompt.")
             return user_prompt
\ No newline at end of file
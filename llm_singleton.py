@@ -1,15 +1,35 @@
+import threading
+
 from llm_handler import LLMHandler
 
 _llm_handler_instance = None
+_lock = threading.Lock()
 
-def get_llm_handler():
+def get_llm_handler(config: dict = None):
     """
     Returns a single persistent LLMHandler instance.
     Prevents GPU memory from being released even after Streamlit reloads.
+
+    An already-parsed config dict may be passed to spare the handler a
+    redundant config.json read; it only matters on the first call.
+    Double-checked locking keeps concurrent Streamlit threads (e.g. the
+    pre-warm thread racing a user-triggered run) from constructing two
+    handlers, each with its own HTTP pool and model pre-load.
     """
     global _llm_handler_instance
     if _llm_handler_instance is None:
-        print("[LLM] Initializing persistent handler...")
-        _llm_handler_instance = LLMHandler("config.json")
+        with _lock:
+            if _llm_handler_instance is None:
+                print("[LLM] Initializing persistent handler...")
+                _llm_handler_instance = LLMHandler(config=config)
 
     return _llm_handler_instance
+
+
+def reset_llm_handler():
+    """
+    Drops the cached handler so the next get_llm_handler() call rebuilds it,
+    e.g. after the user saves new settings.
+    """
+    global _llm_handler_instance
+    _llm_handler_instance = None
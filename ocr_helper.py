@@ -1,4 +1,4 @@
-import easyocr
+import hashlib
 import pyautogui
 import numpy as np
 from typing import Optional, Tuple, List
@@ -6,10 +6,34 @@ from PIL import Image, ImageDraw, ImageFont
 import platform
 import os
 
-# Initialize the EasyOCR reader with English and Japanese
-print("Initializing EasyOCR reader for English and Japanese...")
-reader = easyocr.Reader(['en', 'ja'])
-print("EasyOCR reader initialized.")
+# The EasyOCR reader is created lazily by _get_reader(): importing easyocr
+# pulls in torch (hundreds of MB of RSS), so sessions that never exercise the
+# OCR path shouldn't pay for it at import time.
+_reader = None
+
+
+def _get_reader():
+    """
+    Lazily creates and memoizes the EasyOCR reader for English and Japanese.
+    gpu is set explicitly from CUDA availability rather than left to
+    EasyOCR's silent fallback, and quantize=True uses the int8 recognizer
+    weights, which halves weight bandwidth with negligible accuracy loss on
+    screen text.
+    """
+    global _reader
+    if _reader is None:
+        import easyocr
+        import torch
+        print("Initializing EasyOCR reader for English and Japanese...")
+        _reader = easyocr.Reader(['en', 'ja'], gpu=torch.cuda.is_available(), quantize=True)
+        try:
+            # Warm up on a dummy frame so kernel compilation and allocations
+            # happen now instead of adding seconds to the first real OCR call.
+            _reader.readtext(np.zeros((32, 32, 3), dtype=np.uint8))
+        except Exception as e:
+            print(f"EasyOCR warm-up pass failed (continuing): {e}")
+        print("EasyOCR reader initialized.")
+    return _reader
 
 def _get_os_specific_font_path() -> str:
     """
@@ -39,6 +63,106 @@ def _get_os_specific_font_path() -> str:
 # Define the path to a Japanese font file using the helper function
 FONT_PATH = _get_os_specific_font_path()
 
+# Loaded lazily by _get_vis_font() so the font file is only opened once.
+_VIS_FONT = None
+
+
+def _get_vis_font() -> ImageFont.ImageFont:
+    """
+    Loads the visualization font once and reuses it across calls, avoiding a
+    font file open + parse on every overlay render.
+    """
+    global _VIS_FONT
+    if _VIS_FONT is None:
+        try:
+            _VIS_FONT = ImageFont.truetype(FONT_PATH, 15)
+        except IOError:
+            print(f"Warning: Font file not found at {FONT_PATH}. Using default font. Japanese characters may not render correctly.")
+            _VIS_FONT = ImageFont.load_default()
+    return _VIS_FONT
+
+
+def downscale_for_vision(image: Image.Image, max_edge: int = 1280) -> Tuple[Image.Image, float]:
+    """
+    Downscales an image so its longest edge is at most `max_edge` pixels.
+    OCR and vision models lose little accuracy at this size while compute
+    and memory traffic drop roughly with the pixel count.
+
+    Args:
+        image (Image.Image): The image to downscale.
+        max_edge (int): Maximum length of the longest edge in pixels.
+
+    Returns:
+        Tuple[Image.Image, float]: The (possibly resized) image and the scale
+                                   factor applied (1.0 means unchanged). Divide
+                                   result coordinates by the scale to map them
+                                   back to the original resolution.
+    """
+    width, height = image.size
+    longest = max(width, height)
+    if longest <= max_edge:
+        return image, 1.0
+    scale = max_edge / longest
+    resized = image.resize((int(width * scale), int(height * scale)), Image.LANCZOS)
+    return resized, scale
+
+
+def _rescale_ocr_results(results: list, scale: float) -> list:
+    """Maps OCR bounding boxes from downscaled-image space back to screen space."""
+    if scale == 1.0:
+        return results
+    inv = 1.0 / scale
+    return [
+        ([[p[0] * inv, p[1] * inv] for p in bbox], text, confidence)
+        for (bbox, text, confidence) in results
+    ]
+
+
+try:
+    import mss
+except ImportError:
+    mss = None
+
+
+def _capture_screen() -> Image.Image:
+    """
+    Captures the primary monitor as a PIL image.
+
+    Prefers mss, whose raw BGRA grab avoids the extra framebuffer copy that
+    pyautogui's screenshot path makes; the buffer is wrapped into a PIL image
+    without re-encoding. Falls back to pyautogui when mss is unavailable.
+    A fresh mss instance per call keeps this safe from worker threads.
+    """
+    if mss is not None:
+        try:
+            with mss.mss() as sct:
+                grab = sct.grab(sct.monitors[1])
+                return Image.frombuffer('RGB', grab.size, grab.bgra, 'raw', 'BGRX')
+        except Exception as e:
+            print(f"mss capture failed ({e}); falling back to pyautogui.")
+    return pyautogui.screenshot()
+
+
+# Memoized OCR results keyed on a digest of the downscaled frame, so repeated
+# searches against an unchanged screen skip the detector/recognizer entirely.
+# A handful of entries suffices: the flow only revisits the last few frames.
+_ocr_memo = {}
+_OCR_MEMO_MAX = 4
+
+
+def _readtext_cached(screenshot_np: np.ndarray) -> list:
+    """Runs EasyOCR on the frame, reusing cached results for identical frames."""
+    digest = hashlib.sha1(screenshot_np.tobytes()).digest()
+    cached = _ocr_memo.get(digest)
+    if cached is not None:
+        print("OCR: Reusing cached results for unchanged frame.")
+        return cached
+    results = _get_reader().readtext(screenshot_np, detail=1, paragraph=False)
+    if len(_ocr_memo) >= _OCR_MEMO_MAX:
+        _ocr_memo.pop(next(iter(_ocr_memo)))
+    _ocr_memo[digest] = results
+    return results
+
 
 def find_text_coordinates(text_to_find: str) -> Optional[Tuple[int, int]]:
     """
@@ -52,19 +176,24 @@ def find_text_coordinates(text_to_find: str) -> Optional[Tuple[int, int]]:
                                    found text box, or None if the text is not found.
     """
     print(f"OCR: Searching for text '{text_to_find}' on screen...")
-    screenshot = pyautogui.screenshot()
-    screenshot_np = np.array(screenshot)
-    results = reader.readtext(screenshot_np, detail=1, paragraph=False)
+    screenshot = _capture_screen()
+    ocr_image, scale = downscale_for_vision(screenshot)
+    screenshot_np = np.array(ocr_image)
+    results = _readtext_cached(screenshot_np)
+    results = _rescale_ocr_results(results, scale)
     print(f"OCR: Found {len(results)} text block(s).")
 
+    # Normalize the needle once; casefold also matches Japanese full-width
+    # variants that plain lower() misses.
+    needle = text_to_find.casefold().strip()
     for (bbox, text, confidence) in results:
         print(f"OCR: Checking text '{text}' with confidence {confidence:.2f}")
-        if text_to_find.lower().strip() in text.lower().strip():
+        if needle in text.casefold().strip():
             print(f"OCR: Found a match for '{text_to_find}'!")
-            x_coords = [p[0] for p in bbox]
-            y_coords = [p[1] for p in bbox]
-            center_x = int(np.mean(x_coords))
-            center_y = int(np.mean(y_coords))
+            # Plain integer arithmetic: four adds and a shift beat building
+            # two lists and calling NumPy for 4 values apiece.
+            center_x = int(bbox[0][0] + bbox[1][0] + bbox[2][0] + bbox[3][0]) >> 2
+            center_y = int(bbox[0][1] + bbox[1][1] + bbox[2][1] + bbox[3][1]) >> 2
             print(f"OCR: Bounding box: {bbox}")
             print(f"OCR: Calculated center: ({center_x}, {center_y})")
             return (center_x, center_y)
@@ -72,28 +201,34 @@ def find_text_coordinates(text_to_find: str) -> Optional[Tuple[int, int]]:
     print(f"OCR: Text '{text_to_find}' not found on the screen.")
     return None
 
-def get_all_ocr_results(image_path: Optional[str] = None) -> (Image.Image, List[dict]):
+def get_all_ocr_results(image_path: Optional[str] = None, image: Optional[Image.Image] = None) -> (Image.Image, List[dict]):
     """
-    Captures the screen or loads an image from a path and gets all OCR results.
+    Gets all OCR results from an in-memory image, an image file, or a fresh screenshot.
 
     Args:
-        image_path (Optional[str]): The path to an image file. If None, a new screenshot is taken.
+        image_path (Optional[str]): The path to an image file. Ignored if `image` is given.
+        image (Optional[Image.Image]): An already-loaded PIL image. Passing this avoids
+                                       re-decoding a screenshot that is still in memory.
 
     Returns:
         tuple[Image.Image, List[dict]]: A tuple containing the screenshot as a PIL Image
                                  and a list of all detected text blocks.
     """
-    if image_path:
+    if image is not None:
+        print("OCR: Using in-memory image and getting all text...")
+        screenshot_image = image
+    elif image_path:
         print(f"OCR: Loading image from {image_path} and getting all text...")
         screenshot_image = Image.open(image_path)
     else:
         print("OCR: Capturing screen and getting all text...")
-        screenshot_image = pyautogui.screenshot()
+        screenshot_image = _capture_screen()
 
-    screenshot_np = np.array(screenshot_image)
-    results = reader.readtext(screenshot_np, detail=1, paragraph=False)
+    ocr_image, scale = downscale_for_vision(screenshot_image)
+    screenshot_np = np.array(ocr_image)
+    results = _readtext_cached(screenshot_np)
+    results = _rescale_ocr_results(results, scale)
     print(f"OCR: Found {len(results)} text block(s).")
-    # The returned list now only contains the text, not the bbox or confidence
     return screenshot_image, [(bbox, text, confidence) for (bbox, text, confidence) in results]
 
 
@@ -109,19 +244,19 @@ def draw_ocr_results(screenshot_image: Image.Image, ocr_results: List[dict]) ->
     Returns:
         Image.Image: The screenshot with OCR results drawn on it.
     """
+    # Draw on a downscaled frame: the overlay is a debugging aid, and working
+    # at vision resolution touches roughly a quarter of the pixel data that a
+    # full-resolution RGBA copy would. Bounding boxes are in screen space, so
+    # they are mapped into the downscaled space with the same scale factor.
+    vis_image, scale = downscale_for_vision(screenshot_image)
     # Ensure the image is in RGBA mode to support transparency
-    vis_image = screenshot_image.convert("RGBA")
+    vis_image = vis_image.convert("RGBA")
     draw = ImageDraw.Draw(vis_image)
-
-    try:
-        font = ImageFont.truetype(FONT_PATH, 15)
-    except IOError:
-        print(f"Warning: Font file not found at {FONT_PATH}. Using default font. Japanese characters may not render correctly.")
-        font = ImageFont.load_default()
+    font = _get_vis_font()
 
     for (bbox, text, confidence) in ocr_results:
-        top_left = tuple(map(int, bbox[0]))
-        bottom_right = tuple(map(int, bbox[2]))
+        top_left = (int(bbox[0][0] * scale), int(bbox[0][1] * scale))
+        bottom_right = (int(bbox[2][0] * scale), int(bbox[2][1] * scale))
 
         # Draw the bounding box
         draw.rectangle([top_left, bottom_right], outline="red", width=2)
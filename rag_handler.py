@@ -1,15 +1,124 @@
+import atexit
 import os
 import json
-import ollama
-from llama_index.core import (
-    Document,
-    VectorStoreIndex,
-    StorageContext,
-    load_index_from_storage,
-)
-from llama_index.embeddings.ollama import OllamaEmbedding
+import re
+import time
+from string import Template
 from typing import List, Dict
 
+# ollama and the llama_index stack are imported lazily (in __init__ and the
+# methods that need them) so importing this module stays cheap for callers
+# that only want the slot-templating helpers.
+
+# Matches the literal arguments of a prompt: quoted strings and numbers.
+_SLOT_RE = re.compile(r"'[^']*'|\"[^\"]*\"|\d+(?:\.\d+)?")
+
+
+def extract_slots(prompt: str):
+    """
+    Templates a prompt by replacing its literal arguments (quoted strings and
+    numbers) with positional placeholders like <STR1> and <NUM1>.
+
+    Returns:
+        tuple[str, dict]: The templated prompt and a mapping of placeholder
+                          names to the literal values (quotes stripped).
+    """
+    slots = {}
+    counters = {"STR": 0, "NUM": 0}
+
+    def _replace(match):
+        token = match.group(0)
+        kind = "STR" if token[0] in "'\"" else "NUM"
+        counters[kind] += 1
+        name = f"{kind}{counters[kind]}"
+        slots[name] = token.strip("'\"") if kind == "STR" else token
+        return f"<{name}>"
+
+    return _SLOT_RE.sub(_replace, prompt), slots
+
+
+# Slot values shorter than this are too ambiguous to templatize: a literal
+# like "2" occurs coincidentally all over generated code (sleep durations,
+# coordinates), and rewriting those occurrences would synthesize corrupted
+# scripts on a structural hit with a different argument.
+_MIN_SLOT_LEN = 3
+
+
+def _parametrize_code(code: str, slots: dict) -> str:
+    """
+    Replaces the prompt's literal slot values inside the code with ${NAME}
+    placeholders, producing a string.Template skeleton. Longer values are
+    substituted first so a value that contains another is not mangled, and
+    numeric values only match at token boundaries so "250" is never rewritten
+    inside "1250". Returns "" (no skeleton — structural reuse disabled for
+    this record) when a slot value is too short to substitute safely or the
+    skeleton fails to round-trip back to the original code.
+    """
+    skeleton = code.replace("$", "$$")
+    for name, value in sorted(slots.items(), key=lambda kv: -len(kv[1])):
+        if len(value) < _MIN_SLOT_LEN:
+            return ""
+        placeholder = "${%s}" % name
+        if name.startswith("NUM"):
+            skeleton = re.sub(
+                rf"(?<![\w.]){re.escape(value)}(?![\w.])", placeholder, skeleton)
+        else:
+            skeleton = skeleton.replace(value, placeholder)
+    # Every slot must have produced a placeholder: a value that never appears
+    # verbatim in the code (prompt says 'Notepad', code says notepad.exe)
+    # would otherwise leave the old literal baked into the skeleton, and a
+    # structural hit would execute code with a stale argument.
+    if any("${%s}" % name not in skeleton for name in slots):
+        return ""
+    # Substituting the original values back must reproduce the code exactly;
+    # anything else means the replacements interacted (e.g. a value matched
+    # inside an earlier placeholder) and the skeleton cannot be trusted.
+    if Template(skeleton).safe_substitute(slots) != code:
+        return ""
+    return skeleton
+
+
+# Built lazily by _get_batch_embedding_cls(); the class statement needs
+# OllamaEmbedding, which sits behind the llama_index import.
+_batch_embedding_cls = None
+
+
+def _get_batch_embedding_cls():
+    """Defines (once) and returns the batch-capable embedding class."""
+    global _batch_embedding_cls
+    if _batch_embedding_cls is not None:
+        return _batch_embedding_cls
+
+    from llama_index.embeddings.ollama import OllamaEmbedding
+
+    class BatchOllamaEmbedding(OllamaEmbedding):
+        """
+        OllamaEmbedding variant that embeds whole batches in one request.
+
+        The stock implementation hits the older /api/embeddings endpoint once
+        per text, so inserting N documents costs N HTTP round trips. The newer
+        /api/embed endpoint accepts a list input, collapsing an entire insert
+        batch into a single call. Falls back to the per-text path on any error.
+        """
+
+        def _get_text_embeddings(self, texts: List[str]) -> List[List[float]]:
+            import httpx
+            try:
+                response = httpx.post(
+                    f"{self.base_url.rstrip('/')}/api/embed",
+                    json={"model": self.model_name, "input": texts},
+                    timeout=600,
+                )
+                response.raise_for_status()
+                return response.json()["embeddings"]
+            except Exception as e:
+                print(f"Batch embedding via /api/embed failed ({e}); falling back to per-text embedding.")
+                return super()._get_text_embeddings(texts)
+
+    _batch_embedding_cls = BatchOllamaEmbedding
+    return _batch_embedding_cls
+
+
 class RAGHandler:
     """
     Handles the Retrieval-Augmented Generation functionality, including
@@ -19,6 +128,13 @@ class RAGHandler:
         """
         Initializes the RAG handler, loading or creating the vector index.
         """
+        import ollama
+        from llama_index.core import (
+            VectorStoreIndex,
+            StorageContext,
+            load_index_from_storage,
+        )
+
         self.vector_db_path = vector_db_path
         os.makedirs(self.vector_db_path, exist_ok=True)
 
@@ -37,7 +153,7 @@ class RAGHandler:
             print(f"Could not pre-load embedding model: {e}")
 
 
-        self.embed_model = OllamaEmbedding(
+        self.embed_model = _get_batch_embedding_cls()(
             model_name=config['embedding_model'],
             base_url=embedding_ollama_url,
         )
@@ -54,6 +170,19 @@ class RAGHandler:
             self.index.storage_context.persist(self.vector_db_path)
             print("New RAG index created.")
 
+        # Write-behind persistence: each insert rewrites the whole docstore
+        # when persisted eagerly, so inserts only mark the index dirty and a
+        # flush runs once per batch of inserts / time window (and at exit).
+        self._dirty = False
+        self._pending = 0
+        self._last_flush = time.time()
+        atexit.register(self._force_flush)
+
+        # Retriever objects are cached per top_k: they query the live vector
+        # store, so one instance serves every retrieval instead of rebuilding
+        # the retriever pipeline on each call.
+        self._retrievers = {}
+
     def add_successful_automation(self, abstract_prompt: str, original_prompt: str, python_code: str):
         """
         Adds a successfully executed automation script to the vector index.
@@ -64,24 +193,140 @@ class RAGHandler:
             original_prompt (str): The initial user instruction.
             python_code (str): The Python code that successfully performed the task.
         """
+        from llama_index.core import Document
+
         # We create a Document where the text is the ABSTRACT prompt for better searching,
-        # and the original prompt and code are metadata.
+        # and the original prompt and code are metadata. The templated prompt
+        # and code skeleton enable structural reuse via try_generative_hit.
         doc = Document(
             text=abstract_prompt,
-            metadata={
-                "python_code": python_code,
-                "original_prompt": original_prompt
-            }
+            metadata=self._build_metadata(original_prompt, python_code)
         )
 
         try:
             print(f"Adding new document to RAG index for abstract prompt: {abstract_prompt}")
             self.index.insert(doc)
-            self.index.storage_context.persist(self.vector_db_path)
-            print("Document added and index persisted.")
+            self._mark_dirty()
+            print("Document added.")
         except Exception as e:
             print(f"Failed to add document to RAG index: {e}")
 
+    def _get_retriever(self, top_k: int):
+        """Returns a cached retriever for the given top_k."""
+        retriever = self._retrievers.get(top_k)
+        if retriever is None:
+            retriever = self.index.as_retriever(similarity_top_k=top_k)
+            self._retrievers[top_k] = retriever
+        return retriever
+
+    def _mark_dirty(self):
+        """Records an unpersisted insert and flushes once the window closes."""
+        self._dirty = True
+        self._pending += 1
+        if self._pending >= 8 or time.time() - self._last_flush > 30:
+            self._force_flush()
+
+    def _force_flush(self):
+        """Persists the index to disk if any inserts are pending."""
+        if not self._dirty:
+            return
+        try:
+            self.index.storage_context.persist(self.vector_db_path)
+            self._dirty = False
+            self._pending = 0
+            self._last_flush = time.time()
+            print("RAG index persisted.")
+        except Exception as e:
+            print(f"Failed to persist RAG index: {e}")
+
+    @staticmethod
+    def _build_metadata(original_prompt: str, python_code: str) -> Dict:
+        """Builds the document metadata, including the structural-reuse fields."""
+        template, slots = extract_slots(original_prompt)
+        return {
+            "python_code": python_code,
+            "original_prompt": original_prompt,
+            "prompt_template": template,
+            "code_skeleton": _parametrize_code(python_code, slots),
+            "slot_schema": sorted(slots),
+        }
+
+    def try_generative_hit(self, user_prompt: str, threshold: float = 0.92):
+        """
+        Structural cache lookup: if a stored automation has the same prompt
+        shape as `user_prompt` (only the literal arguments differ), the new
+        arguments are substituted back into its code skeleton and the
+        synthesized script is returned — no LLM call needed.
+
+        Args:
+            user_prompt (str): The new user instruction.
+            threshold (float): Minimum similarity score for a hit.
+
+        Returns:
+            Optional[str]: The synthesized code, or None when nothing matches.
+        """
+        if len(self.index.docstore.docs) == 0:
+            return None
+
+        template, slots = extract_slots(user_prompt)
+        try:
+            retrieved_nodes = self._get_retriever(1).retrieve(template)
+        except Exception as e:
+            print(f"Structural cache lookup failed: {e}")
+            return None
+        if not retrieved_nodes:
+            return None
+
+        node = retrieved_nodes[0]
+        score = node.score or 0.0
+        skeleton = node.metadata.get("code_skeleton")
+        stored_template = node.metadata.get("prompt_template", "")
+        # A hit needs high similarity AND an identical slot shape, so the new
+        # arguments drop cleanly into the stored skeleton.
+        if score < threshold or not skeleton or node.metadata.get("slot_schema") != sorted(slots):
+            return None
+        if stored_template != template:
+            return None
+
+        print(f"Structural cache hit (score {score:.3f}) for template: {template}")
+        return Template(skeleton).safe_substitute(slots)
+
+    def add_successful_automations_batch(self, records: List[Dict[str, str]], batch_size: int = 32):
+        """
+        Adds many successful automations to the vector index in one pass.
+
+        Documents are inserted in batches so embeddings are computed per batch
+        rather than one HTTP round-trip per record, and the index is persisted
+        once at the end instead of after every insert.
+
+        Args:
+            records: Dicts with 'abstract_prompt', 'original_prompt' and
+                'python_code' keys, as for add_successful_automation.
+            batch_size (int): Number of documents to embed/insert per batch.
+        """
+        from llama_index.core import Document
+
+        docs = [
+            Document(
+                text=record["abstract_prompt"],
+                metadata=self._build_metadata(record["original_prompt"], record["python_code"])
+            )
+            for record in records
+        ]
+        if not docs:
+            return
+
+        try:
+            for start in range(0, len(docs), batch_size):
+                batch = docs[start:start + batch_size]
+                print(f"Inserting batch of {len(batch)} document(s) into RAG index...")
+                self.index.insert_nodes(batch)
+            self._dirty = True
+            self._force_flush()
+            print(f"Added {len(docs)} document(s) and persisted index.")
+        except Exception as e:
+            print(f"Failed to batch-add documents to RAG index: {e}")
+
     def retrieve_similar_examples(self, user_prompt: str, top_k: int = 2) -> List[Dict[str, str]]:
         """
         Retrieves the most similar successful automation scripts from the index.
@@ -98,20 +343,67 @@ class RAGHandler:
             return []
 
         print(f"Querying RAG index for similar examples to: {user_prompt}")
-        retriever = self.index.as_retriever(similarity_top_k=top_k)
-        retrieved_nodes = retriever.retrieve(user_prompt)
+        retrieved_nodes = self._get_retriever(top_k).retrieve(user_prompt)
 
-        examples = []
-        if retrieved_nodes:
-            for node in retrieved_nodes:
-                # We search by the abstract prompt (node.get_content()),
-                # but we use the *original* prompt for the few-shot example.
-                original_prompt = node.metadata.get("original_prompt")
-                code = node.metadata.get("python_code", "")
-                if code and original_prompt:
-                    examples.append({"prompt": original_prompt, "code": code})
+        examples = self._nodes_to_examples(retrieved_nodes)
+        if examples:
             print(f"Retrieved {len(examples)} similar example(s).")
         else:
             print("No similar examples found.")
 
         return examples
+
+    @staticmethod
+    def _nodes_to_examples(retrieved_nodes) -> List[Dict[str, str]]:
+        """Converts retrieved nodes into few-shot example dicts."""
+        examples = []
+        for node in retrieved_nodes or []:
+            # We search by the abstract prompt (node.get_content()),
+            # but we use the *original* prompt for the few-shot example.
+            original_prompt = node.metadata.get("original_prompt")
+            code = node.metadata.get("python_code", "")
+            if code and original_prompt:
+                examples.append({"prompt": original_prompt, "code": code})
+        return examples
+
+    def retrieve_similar_examples_batch(self, prompts: List[str], top_k: int = 2) -> List[List[Dict[str, str]]]:
+        """
+        Retrieves similar examples for many prompts in one pass.
+
+        All prompts are embedded with a single /api/embed request (via the
+        batch embedding model), and each precomputed embedding is handed to
+        the retriever through a QueryBundle so the per-prompt retrieve only
+        scans the vector store — the per-query embedding HTTP round-trip is
+        amortized across the whole batch. Useful for offline replay and
+        multi-step planning, where commands arrive several at a time.
+
+        Args:
+            prompts: The user instructions to look up.
+            top_k (int): The number of similar examples to retrieve per prompt.
+
+        Returns:
+            One example list per prompt, in the same order as `prompts`.
+        """
+        if not prompts:
+            return []
+        if len(self.index.docstore.docs) == 0:
+            print("RAG index is empty. No examples to retrieve.")
+            return [[] for _ in prompts]
+
+        from llama_index.core.schema import QueryBundle
+
+        print(f"Batch-querying RAG index for {len(prompts)} prompt(s)...")
+        try:
+            embeddings = self.embed_model._get_text_embeddings(list(prompts))
+        except Exception as e:
+            print(f"Batch embedding failed ({e}); falling back to per-prompt retrieval.")
+            return [self.retrieve_similar_examples(p, top_k=top_k) for p in prompts]
+
+        retriever = self._get_retriever(top_k)
+        results = []
+        for prompt, embedding in zip(prompts, embeddings):
+            bundle = QueryBundle(query_str=prompt, embedding=embedding)
+            retrieved_nodes = retriever.retrieve(bundle)
+            results.append(self._nodes_to_examples(retrieved_nodes))
+        print(f"Batch retrieval done for {len(results)} prompt(s).")
+        return results